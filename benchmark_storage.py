@@ -0,0 +1,262 @@
+"""Storage benchmarks for the bot data backends
+
+Generates synthetic datasets at several sizes and measures, per backend:
+startup load time, per-operation latency (p50/p99), bytes written per XP
+event and peak RSS. Generation and every (backend, size) measurement run in
+their own processes so startup time and peak RSS are not polluted by earlier
+runs (Linux carries the RSS high-water mark across fork and exec).
+
+Usage:
+    python benchmark_storage.py [--sizes 10000,100000,1000000] [--backends json,sqlite]
+                                [--output results.json] [--baseline old.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+BACKENDS = ('json', 'sqlite')
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+USER_ID_BASE = 100_000_000_000_000_000  # Snowflake-sized IDs
+GUILD_ID_BASE = 900_000_000_000_000_000
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def summarize(samples_ns):
+    samples = sorted(samples_ns)
+    return {
+        'count': len(samples),
+        'p50_us': percentile(samples, 0.50) / 1000,
+        'p99_us': percentile(samples, 0.99) / 1000,
+        'mean_us': sum(samples) / len(samples) / 1000
+    }
+
+def timed(samples, func, *args):
+    start = time.perf_counter_ns()
+    result = func(*args)
+    samples.append(time.perf_counter_ns() - start)
+    return result
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def bytes_written():
+    """Bytes this process has passed to write() so far, or None if unavailable"""
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+        return getattr(counters, 'write_chars', counters.write_bytes)
+    except (ImportError, AttributeError):
+        pass
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def dataset_ids(users, guilds):
+    """Guild IDs and the user IDs of each guild for a dataset"""
+    guild_ids = [GUILD_ID_BASE + index for index in range(guilds)]
+    per_guild = max(1, users // guilds)
+    return {guild_id: range(USER_ID_BASE + index * per_guild, USER_ID_BASE + (index + 1) * per_guild)
+            for index, guild_id in enumerate(guild_ids)}
+
+def generate_dataset(directory, backend, users, guilds, seed):
+    """Write a synthetic dataset in the backend's on-disk format"""
+    import main
+    rng = random.Random(seed)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        if backend == 'sqlite':
+            store = main.SqliteDataStore(main.SQLITE_FILE)
+            store.connect()
+        else:
+            store = main.DataStore(main.DATA_FILE)
+            store.load()
+        ticket_ids = iter(range(1, users + 1))
+        for guild_id, user_ids in dataset_ids(users, guilds).items():
+            if backend == 'sqlite':
+                store.db.executemany(
+                    'INSERT INTO user_levels VALUES (?, ?, ?, ?, ?)',
+                    ((guild_id, user_id, *main.level_from_total_xp(total_xp), total_xp)
+                     for user_id, total_xp in ((user_id, rng.randrange(50_000)) for user_id in user_ids)))
+            else:
+                table = main.LevelTable()
+                for user_id in user_ids:
+                    table.add(user_id, rng.randrange(50_000))
+                store._partition(guild_id)['user_levels'] = table
+                store.dirty_guilds.add(str(guild_id))
+            # A ticket and a warning for roughly one user in a thousand
+            for user_id in rng.sample(user_ids, max(1, len(user_ids) // 1000)):
+                store.create_ticket(main.Ticket(next(ticket_ids), guild_id, user_id, None,
+                                                '2024-01-01T00:00:00', 'benchmark'))
+                store.add_warning(guild_id, user_id, 'benchmark', USER_ID_BASE)
+        store.flush()
+        main.file_writer.drain()
+    finally:
+        os.chdir(cwd)
+
+def run_worker(backend, users, guilds, ops, ranking_ops, seed):
+    """Measure one backend on the dataset in the current directory"""
+    import main
+    rng = random.Random(seed + 1)
+    guild_users = dataset_ids(users, guilds)
+    guild_ids = list(guild_users)
+    result = {'backend': backend, 'users': users, 'guilds': guilds}
+
+    start = time.perf_counter()
+    if backend == 'sqlite':
+        store = main.SqliteDataStore(main.SQLITE_FILE)
+    else:
+        store = main.DataStore(main.DATA_FILE)
+    store.load()
+    result['startup_load_s'] = time.perf_counter() - start
+    start = time.perf_counter()
+    store.get_level(guild_ids[0], guild_users[guild_ids[0]][0])
+    result['first_guild_load_s'] = time.perf_counter() - start
+
+    def random_member():
+        guild_id = rng.choice(guild_ids)
+        return guild_id, rng.choice(guild_users[guild_id])
+
+    samples = {'add_experience': [], 'get_level': [], 'top_levels': [], 'flush': []}
+    written_before = bytes_written()
+    for _ in range(ops):
+        timed(samples['add_experience'], store.add_experience, *random_member(), 5)
+    # Fold everything into the snapshot so bytes per event include compaction
+    if backend == 'json':
+        store.compact()
+    else:
+        store.flush()
+    main.file_writer.drain()
+    written_after = bytes_written()
+    if written_before is not None and written_after is not None:
+        result['bytes_written_per_xp_event'] = (written_after - written_before) / ops
+
+    for _ in range(ops):
+        timed(samples['get_level'], store.get_level, *random_member())
+    for _ in range(ranking_ops):
+        timed(samples['top_levels'], store.top_levels, rng.choice(guild_ids), 10)
+
+    def durable_flush():
+        store.flush()
+        main.file_writer.drain()
+    for _ in range(20):
+        for _ in range(100):
+            store.add_experience(*random_member(), 5)
+        timed(samples['flush'], durable_flush)
+
+    result['ops'] = {name: summarize(op_samples) for name, op_samples in samples.items()}
+    result['peak_rss_bytes'] = peak_rss_bytes()
+    return result
+
+def compare(results, baseline, tolerance):
+    """Regressions of more than tolerance against a previous results file"""
+    previous = {(run['backend'], run['users']): run for run in baseline['results']}
+    regressions = []
+    for run in results:
+        old = previous.get((run['backend'], run['users']))
+        if old is None:
+            continue
+        metrics = [('startup_load_s',), ('peak_rss_bytes',), ('bytes_written_per_xp_event',)]
+        metrics += [('ops', name, 'p99_us') for name in run['ops']]
+        for metric in metrics:
+            new_value, old_value = run, old
+            for key in metric:
+                new_value = new_value.get(key) if isinstance(new_value, dict) else None
+                old_value = old_value.get(key) if isinstance(old_value, dict) else None
+            if new_value is None or not old_value:
+                continue
+            if new_value > old_value * (1 + tolerance):
+                regressions.append({'backend': run['backend'], 'users': run['users'], 'metric': '.'.join(metric),
+                                    'baseline': old_value, 'current': new_value})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help='comma-separated user counts')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma-separated backends')
+    parser.add_argument('--guilds', type=int, default=10, help='guilds the users are spread over')
+    parser.add_argument('--ops', type=int, default=10_000, help='samples for XP and level lookups')
+    parser.add_argument('--ranking-ops', type=int, default=50, help='samples for top_levels')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results JSON here instead of stdout')
+    parser.add_argument('--baseline', help='previous results JSON to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before a regression')
+    parser.add_argument('--generate', nargs=3, metavar=('BACKEND', 'USERS', 'DIR'), help=argparse.SUPPRESS)
+    parser.add_argument('--worker', nargs=2, metavar=('BACKEND', 'USERS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.generate:
+        backend, users, directory = args.generate
+        generate_dataset(directory, backend, int(users), args.guilds, args.seed)
+        return 0
+    if args.worker:
+        backend, users = args.worker[0], int(args.worker[1])
+        result = run_worker(backend, users, args.guilds, args.ops, args.ranking_ops, args.seed)
+        print(json.dumps(result))
+        return 0
+
+    script = os.path.abspath(__file__)
+    results = []
+    for users in map(int, args.sizes.split(',')):
+        for backend in args.backends.split(','):
+            if backend not in BACKENDS:
+                parser.error(f'unknown backend {backend!r}')
+            common = ['--guilds', str(args.guilds), '--seed', str(args.seed)]
+            with tempfile.TemporaryDirectory(prefix='bench-') as directory:
+                print(f"Generating {users} users for {backend}...", file=sys.stderr)
+                subprocess.run([sys.executable, script, '--generate', backend, str(users), directory] + common,
+                               check=True, stdout=subprocess.DEVNULL)
+                print(f"Benchmarking {backend} with {users} users...", file=sys.stderr)
+                output = subprocess.run(
+                    [sys.executable, script, '--worker', backend, str(users), '--ops', str(args.ops),
+                     '--ranking-ops', str(args.ranking_ops)] + common,
+                    cwd=directory, check=True, stdout=subprocess.PIPE, text=True).stdout
+                # main.py prints its own log lines; the result is the last line
+                results.append(json.loads(output.strip().splitlines()[-1]))
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results
+    }
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            report['regressions'] = compare(results, json.load(f), args.tolerance)
+        exit_code = 1 if report['regressions'] else 0
+
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(payload + '\n')
+    else:
+        print(payload)
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,10 +2,26 @@ import discord
 from discord.ext import commands
 import json
 import os
+import sys
 from datetime import datetime
 from flask import Flask
-from threading import Thread
+from threading import Thread, Condition
 import time
+import asyncio
+import signal
+import sqlite3
+import abc
+import heapq
+import math
+import bisect
+import itertools
+import collections
+import concurrent.futures
+import glob
+import gzip
+import struct
+from array import array
+from dataclasses import dataclass, field
 
 app = Flask(__name__)
 
@@ -28,74 +44,1686 @@ bot = commands.Bot(command_prefix='!', intents=intents)
 
 bot_start_time = datetime.now()
 
-spam_tracker = {}
-bot_spam_tracker = {}
-
-user_message_history = {}
-bot_message_count = {}
-
 DATA_FILE = 'bot_data.json'
+SQLITE_FILE = os.environ.get('SQLITE_FILE', 'bot_data.db')
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')  # 'json' or 'sqlite'
+DATA_FLUSH_INTERVAL = 10  # seconds between write-behind flushes
+DATA_FLUSH_THRESHOLD = 100  # mutations before an early flush
+XP_JOURNAL_FILE = 'bot_data.xp.journal'
+XP_JOURNAL_COMPACT_INTERVAL = 300  # seconds between snapshot compactions
+XP_JOURNAL_COMPACT_THRESHOLD = 5000  # journal records before an early compaction
+
+XP_BATCH_INTERVAL = 5  # seconds between applications of accumulated chat XP
+
+GUILD_DATA_DIR = 'guild_data'
+DATA_BACKUP_DIR = 'backups'
+DATA_BACKUP_COUNT = 5  # compressed snapshots kept per file
+DATA_BACKUP_INTERVAL = 600  # seconds between backups of the same file
+GUILD_PARTITION_IDLE_TTL = 1800  # seconds before an idle guild partition is evicted
+
+DATA_SECTIONS = ('users', 'meta')
+GUILD_SECTIONS = ('user_levels', 'tickets', 'polls', 'warnings')
+
+def level_from_total_xp(total_xp):
+    """Level and in-level XP for a total XP value (100 XP per level)"""
+    return (total_xp // 100) + 1, total_xp % 100
+
+LEADERBOARD_BUCKET_SIZE = 1000  # keys per bucket before it is split in two
+
+class Leaderboard:
+    """Order-statistics index over one guild's total XP
+
+    Keys sort by total XP descending, then user ID, and are kept in sorted
+    buckets (as in sortedcontainers.SortedList). A Fenwick tree over the bucket
+    lengths maps ranks to buckets, so updates, rank lookups and slices at an
+    offset cost O(log n) plus a bisect inside one bucket.
+    """
+
+    __slots__ = ('buckets', 'maxes', 'tree', 'size')
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self.buckets = [keys[i:i + LEADERBOARD_BUCKET_SIZE] for i in range(0, len(keys), LEADERBOARD_BUCKET_SIZE)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.size = len(keys)
+        self._build_tree()
+
+    @staticmethod
+    def key(user_id, total_xp):
+        """Single-int sort key: higher XP first, ties broken by user ID"""
+        return (-total_xp << 64) + user_id
+
+    @staticmethod
+    def decode(key):
+        """(user_id, total_xp) for a key"""
+        return key & 0xFFFFFFFFFFFFFFFF, -(key >> 64)
+
+    def __len__(self):
+        return self.size
+
+    def _build_tree(self):
+        tree = [0] * (len(self.buckets) + 1)
+        for index, bucket in enumerate(self.buckets, 1):
+            tree[index] += len(bucket)
+            parent = index + (index & -index)
+            if parent < len(tree):
+                tree[parent] += tree[index]
+        self.tree = tree
+
+    def _tree_add(self, bucket_index, delta):
+        tree = self.tree
+        index = bucket_index + 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+
+    def _prefix(self, bucket_index):
+        """Number of keys in the buckets before bucket_index"""
+        total = 0
+        while bucket_index > 0:
+            total += self.tree[bucket_index]
+            bucket_index -= bucket_index & -bucket_index
+        return total
+
+    def _locate(self, position):
+        """(bucket index, offset in bucket) of the key at a 0-based position"""
+        tree = self.tree
+        index = 0
+        step = 1 << (len(self.buckets).bit_length() - 1) if self.buckets else 0
+        while step:
+            candidate = index + step
+            if candidate < len(tree) and tree[candidate] <= position:
+                index = candidate
+                position -= tree[candidate]
+            step >>= 1
+        return index, position
+
+    def add(self, key):
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            self.size = 1
+            self._build_tree()
+            return
+        index = bisect.bisect_left(self.maxes, key)
+        if index == len(self.maxes):
+            index -= 1
+            self.buckets[index].append(key)
+            self.maxes[index] = key
+        else:
+            bisect.insort(self.buckets[index], key)
+        self.size += 1
+        bucket = self.buckets[index]
+        if len(bucket) > 2 * LEADERBOARD_BUCKET_SIZE:
+            self.buckets[index:index + 1] = [bucket[:LEADERBOARD_BUCKET_SIZE], bucket[LEADERBOARD_BUCKET_SIZE:]]
+            self.maxes[index:index + 1] = [bucket[LEADERBOARD_BUCKET_SIZE - 1], bucket[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(index, 1)
 
-def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {
-        'users': {},
-        'tickets': {},
-        'polls': {},
-        'user_levels': {}
-    }
+    def discard(self, key):
+        index = bisect.bisect_left(self.maxes, key)
+        if index == len(self.maxes):
+            return
+        bucket = self.buckets[index]
+        position = bisect.bisect_left(bucket, key)
+        if position == len(bucket) or bucket[position] != key:
+            return
+        del bucket[position]
+        self.size -= 1
+        if not bucket:
+            del self.buckets[index]
+            del self.maxes[index]
+            self._build_tree()
+            return
+        if position == len(bucket):
+            self.maxes[index] = bucket[-1]
+        self._tree_add(index, -1)
+
+    def rank(self, key):
+        """Number of keys that sort before key"""
+        index = bisect.bisect_left(self.maxes, key)
+        if index == len(self.maxes):
+            return self.size
+        return self._prefix(index) + bisect.bisect_left(self.buckets[index], key)
+
+    def slice(self, start, stop):
+        """Keys at positions start..stop-1"""
+        stop = min(stop, self.size)
+        if start >= stop:
+            return []
+        index, offset = self._locate(start)
+        keys = []
+        while len(keys) < stop - start:
+            bucket = self.buckets[index]
+            keys.extend(bucket[offset:offset + stop - start - len(keys)])
+            index += 1
+            offset = 0
+        return keys
+
+_level_table_versions = itertools.count(1)
+
+class LevelTable:
+    """Columnar per-guild level table
+
+    User IDs and total XP are kept in parallel array('q') columns with a
+    user ID -> row index, built on the first lookup after a load; level and xp
+    are derived from total_xp on read. The Leaderboard is built on the first
+    ranking query and kept up to date by add(). version changes on every
+    update and is unique across tables, so cached views can detect staleness.
+    """
+
+    __slots__ = ('user_ids', 'total_xp', '_rows', '_board', 'version')
+
+    MAGIC = b'NLVL'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHxxqQ')  # magic, version, journal seq, row count
 
-def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    def __init__(self):
+        self.user_ids = array('q')
+        self.total_xp = array('q')
+        self._rows = {}  # {user_id: row}
+        self._board = None
+        self.version = next(_level_table_versions)
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = dict(zip(self.user_ids, range(len(self.user_ids))))
+        return self._rows
+
+    @property
+    def board(self):
+        if self._board is None:
+            self._board = Leaderboard(map(Leaderboard.key, self.user_ids, self.total_xp))
+        return self._board
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __contains__(self, user_id):
+        return int(user_id) in self.rows
+
+    def get(self, user_id):
+        """Level data dict for a user, or None if they have no XP yet"""
+        row = self.rows.get(int(user_id))
+        if row is None:
+            return None
+        return self._level_data(self.total_xp[row])
+
+    def add(self, user_id, amount):
+        """Add XP to a user and return their (old, new) total XP"""
+        user_id = int(user_id)
+        row = self.rows.get(user_id)
+        board = self._board
+        if row is None:
+            row = self.rows[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.total_xp.append(0)
+        elif board is not None:
+            board.discard(Leaderboard.key(user_id, self.total_xp[row]))
+        old_total = self.total_xp[row]
+        self.total_xp[row] = old_total + amount
+        self.version = next(_level_table_versions)
+        if board is not None:
+            board.add(Leaderboard.key(user_id, old_total + amount))
+        return old_total, old_total + amount
+
+    def top(self, limit, offset=0):
+        """(user_key, level data) pairs for the users with the most XP"""
+        return [(str(user_id), self._level_data(total_xp))
+                for user_id, total_xp in map(Leaderboard.decode, self.board.slice(offset, offset + limit))]
+
+    def top_totals(self, limit):
+        """(user_id, total_xp) of the users with the most XP, without building the leaderboard"""
+        if self._board is not None:
+            return list(map(Leaderboard.decode, self._board.slice(0, limit)))
+        user_ids, total_xp = self.user_ids, self.total_xp
+        rows = heapq.nlargest(limit, range(len(total_xp)), key=lambda row: (total_xp[row], -user_ids[row]))
+        return [(user_ids[row], total_xp[row]) for row in rows]
+
+    def rank(self, user_id):
+        """1-based leaderboard position of a user, or None if they have no XP yet"""
+        row = self.rows.get(int(user_id))
+        if row is None:
+            return None
+        return self.board.rank(Leaderboard.key(int(user_id), self.total_xp[row])) + 1
+
+    @staticmethod
+    def _level_data(total_xp):
+        level, xp = level_from_total_xp(total_xp)
+        return {'level': level, 'xp': xp, 'total_xp': total_xp}
+
+    def to_dict(self):
+        """Levels in the legacy {user_key: {level, xp, total_xp}} layout"""
+        return {str(user_id): self._level_data(total_xp) for user_id, total_xp in zip(self.user_ids, self.total_xp)}
+
+    @classmethod
+    def from_dict(cls, levels):
+        table = cls()
+        for user_key, level_data in levels.items():
+            table.add(user_key, level_data.get('total_xp', 0))
+        return table
+
+    def to_bytes(self, journal_seq):
+        """Binary snapshot: header followed by the two little-endian columns"""
+        user_ids, total_xp = self.user_ids, self.total_xp
+        if sys.byteorder != 'little':
+            user_ids, total_xp = array('q', user_ids), array('q', total_xp)
+            user_ids.byteswap()
+            total_xp.byteswap()
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, journal_seq, len(user_ids))
+        return b''.join((header, user_ids.tobytes(), total_xp.tobytes()))
+
+    @classmethod
+    def from_bytes(cls, payload):
+        """Parse a binary snapshot into (table, journal seq)"""
+        header_size = cls.HEADER.size
+        if len(payload) < header_size:
+            raise ValueError('level table header is truncated')
+        magic, version, journal_seq, count = cls.HEADER.unpack_from(payload)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f'unsupported level table format {magic!r} v{version}')
+        column_size = count * 8
+        if len(payload) != header_size + 2 * column_size:
+            raise ValueError('level table columns are truncated')
+        table = cls()
+        table.user_ids.frombytes(payload[header_size:header_size + column_size])
+        table.total_xp.frombytes(payload[header_size + column_size:])
+        if sys.byteorder != 'little':
+            table.user_ids.byteswap()
+            table.total_xp.byteswap()
+        table._rows = None
+        return table, journal_seq
+
+def _optional_int(value):
+    return int(value) if value not in (None, '') else None
+
+TICKET_STATUSES = ('open', 'closed')
+
+@dataclass(slots=True)
+class Ticket:
+    """Support ticket with integer snowflakes"""
+    ticket_id: int
+    guild_id: int
+    user_id: int
+    channel_id: int | None
+    created_at: str
+    description: str
+    status: str = 'open'
+    closed_at: str | None = None
+    closed_by: int | None = None
+
+    def close(self, closed_by):
+        self.status = 'closed'
+        self.closed_at = datetime.now().isoformat()
+        self.closed_by = int(closed_by)
+
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'guild_id': self.guild_id,
+            'channel_id': self.channel_id,
+            'created_at': self.created_at,
+            'description': self.description,
+            'status': self.status,
+            'closed_at': self.closed_at,
+            'closed_by': self.closed_by
+        }
 
-# Persistent views storage
-persistent_views = {}
+    @classmethod
+    def from_dict(cls, ticket_id, data):
+        status = data.get('status', 'open')
+        if status not in TICKET_STATUSES:
+            raise ValueError(f"unknown ticket status {status!r}")
+        return cls(int(ticket_id), int(data['guild_id']), int(data['user_id']), _optional_int(data.get('channel_id')),
+                   data.get('created_at', ''), data.get('description', ''), status,
+                   data.get('closed_at'), _optional_int(data.get('closed_by')))
+
+@dataclass(slots=True)
+class Poll:
+    """Poll with per-option vote counts and a {user_id: option_index} voter map"""
+    poll_id: int
+    guild_id: int
+    channel_id: int | None
+    question: str
+    options: list
+    creator: str
+    votes: list = None
+    voters: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        if self.votes is None:
+            self.votes = [0] * len(self.options)
+
+    def vote(self, user_id, option_index):
+        """Record or move a user's vote"""
+        previous = self.voters.get(user_id)
+        if previous is not None:
+            self.votes[previous] -= 1
+        self.voters[user_id] = option_index
+        self.votes[option_index] += 1
+
+    def to_dict(self):
+        return {
+            'question': self.question,
+            'options': self.options,
+            'votes': self.votes,
+            'voters': {str(user_id): option_index for user_id, option_index in self.voters.items()},
+            'creator': self.creator,
+            'channel_id': self.channel_id,
+            'guild_id': self.guild_id
+        }
 
-def save_persistent_views():
-    """Save persistent view data"""
-    try:
-        with open('persistent_views.json', 'w', encoding='utf-8') as f:
-            json.dump(persistent_views, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error saving persistent views: {e}")
+    @classmethod
+    def from_dict(cls, poll_id, data):
+        options = list(data['options'])
+        votes = list(data.get('votes') or [0] * len(options))
+        if len(votes) != len(options):
+            raise ValueError(f"poll {poll_id} has {len(votes)} vote counts for {len(options)} options")
+        voters = {int(user_id): int(option_index) for user_id, option_index in data.get('voters', {}).items()}
+        return cls(int(poll_id), int(data['guild_id']), _optional_int(data.get('channel_id')), data['question'],
+                   options, data.get('creator', ''), votes, voters)
+
+@dataclass(slots=True)
+class WarningRecord:
+    """One moderator warning issued to a user"""
+    reason: str
+    moderator_id: int | None
+    timestamp: str
+
+    def to_dict(self):
+        return {'reason': self.reason, 'moderator_id': self.moderator_id, 'timestamp': self.timestamp}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('reason', ''), _optional_int(data.get('moderator_id')), data.get('timestamp', ''))
+
+def _decode_records(records, decode, label):
+    """{int key: decode(key, value)} for a string-keyed JSON mapping, skipping invalid entries"""
+    decoded = {}
+    for key, value in records.items():
+        try:
+            decoded[int(key)] = decode(key, value)
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Skipping invalid {label} {key}: {e}")
+    return decoded
+
+PERSISTENT_VIEW_TYPES = ('ticket_panel', 'ticket_close', 'public_auth', 'specific_role')
+
+@dataclass(slots=True)
+class PersistentViewRecord:
+    """Message carrying a persistent view that has to be re-registered after a restart"""
+    view_type: str
+    guild_id: int | None = None
+    channel_id: int | None = None
+    message_id: int | None = None
+    ticket_id: int | None = None
+    role_id: int | None = None
+    category_name: str | None = None
+
+    def to_dict(self):
+        data = {'type': self.view_type}
+        for name in ('guild_id', 'channel_id', 'message_id', 'ticket_id', 'role_id', 'category_name'):
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        view_type = data['type']
+        if view_type not in PERSISTENT_VIEW_TYPES:
+            raise ValueError(f"unknown persistent view type {view_type!r}")
+        return cls(view_type, _optional_int(data.get('guild_id')), _optional_int(data.get('channel_id')),
+                   _optional_int(data.get('message_id')), _optional_int(data.get('ticket_id')),
+                   _optional_int(data.get('role_id')), data.get('category_name'))
+
+class FileWriter:
+    """Single background thread for data and config file writes
+
+    Operations run in submission order. A write to a path that is still queued
+    replaces the queued payload instead of adding another write, so bursts of
+    saves collapse into one. Every operation returns a concurrent Future that
+    can be awaited with asyncio.wrap_future when durability matters.
+    """
 
-def load_persistent_views():
-    """Load persistent view data"""
-    global persistent_views
+    def __init__(self):
+        self._cond = Condition()
+        self._queue = collections.deque()  # operation keys in submission order
+        self._pending = {}  # {key: [func, args, futures]}
+        self._call_ids = itertools.count()
+        self._thread = None
+
+    def write(self, path, payload, backup=False):
+        """Queue an atomic rewrite of path with a str or bytes payload"""
+        return self._submit(('write', path), _write_file, (path, payload, backup))
+
+    def call(self, func, *args):
+        """Queue an arbitrary operation behind every write submitted so far"""
+        return self._submit(('call', next(self._call_ids)), func, args)
+
+    def barrier(self):
+        """Future that resolves once everything queued so far has been written"""
+        return self.call(lambda: None)
+
+    def drain(self, timeout=None):
+        """Block until the queue is empty (used at shutdown)"""
+        self.barrier().result(timeout)
+
+    def _submit(self, key, func, args):
+        future = concurrent.futures.Future()
+        with self._cond:
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = [func, args, [future]]
+                self._queue.append(key)
+            else:
+                entry[1] = args
+                entry[2].append(future)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name='file-writer', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                key = self._queue.popleft()
+                func, args, futures = self._pending.pop(key)
+            try:
+                result = func(*args)
+            except Exception as e:
+                print(f"Error in file writer ({key[1]}): {e}")
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future in futures:
+                    future.set_result(result)
+
+def _write_file(path, payload, backup=False):
+    """Replace path atomically: write a temp file, fsync it, then rename it over path"""
+    data = payload if isinstance(payload, bytes) else payload.encode('utf-8')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
     try:
-        if os.path.exists('persistent_views.json'):
-            with open('persistent_views.json', 'r', encoding='utf-8') as f:
-                persistent_views = json.load(f)
-    except Exception as e:
-        print(f"Error loading persistent views: {e}")
-        persistent_views = {}
+        dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    except OSError:
+        pass  # Directories cannot be opened on Windows
+    else:
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    if backup:
+        _backup_snapshot(path, data)
+
+def _remove_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+_last_backup = {}  # {path: time of the last backup}, only touched by the writer thread
+
+def _backup_snapshot(path, data):
+    """Keep the newest DATA_BACKUP_COUNT gzip copies of a snapshot"""
+    now = time.time()
+    if now - _last_backup.get(path, 0) < DATA_BACKUP_INTERVAL:
+        return
+    _last_backup[path] = now
+    base = os.path.join(DATA_BACKUP_DIR, path)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    with gzip.open(f'{base}.{int(now * 1000)}.gz', 'wb') as f:
+        f.write(data)
+    for old_backup in list_backups(path)[DATA_BACKUP_COUNT:]:
+        os.remove(old_backup)
+
+def list_backups(path):
+    """Compressed backups of path, newest first"""
+    base = os.path.join(DATA_BACKUP_DIR, path)
+    return sorted(glob.glob(f'{glob.escape(base)}.*.gz'),
+                  key=lambda backup: int(backup.rsplit('.', 2)[1]), reverse=True)
+
+def read_json_snapshot(path):
+    """Load a JSON snapshot, falling back to the newest valid backup if it is corrupt"""
+    return read_snapshot(path, json.loads)
+
+def read_snapshot(path, decode):
+    """Decode a snapshot's bytes, falling back to the newest backup decode accepts"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return decode(f.read())
+    except (OSError, ValueError) as e:
+        print(f"Error loading {path}: {e}")
+    for backup in list_backups(path):
+        try:
+            with gzip.open(backup, 'rb') as f:
+                data = decode(f.read())
+        except (OSError, ValueError, EOFError) as e:
+            print(f"Skipping backup {backup}: {e}")
+            continue
+        print(f"Recovered {path} from backup {backup}")
+        return data
+    raise RuntimeError(f"{path} is corrupt and no valid backup exists")
+
+file_writer = FileWriter()
+
+class WriteBehindStore(abc.ABC):
+    """Shared timer/threshold flushing for the storage backends"""
+
+    def __init__(self, flush_interval=DATA_FLUSH_INTERVAL, flush_threshold=DATA_FLUSH_THRESHOLD):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.pending_mutations = 0
+        self._flush_task = None
+
+    def mark_dirty(self, section):
+        """Record a mutation of a section and flush early after enough mutations"""
+        self.pending_mutations += 1
+        if self.pending_mutations >= self.flush_threshold:
+            self.flush()
+
+    @abc.abstractmethod
+    def flush(self):
+        """Write pending mutations out"""
+
+    def periodic_flush(self):
+        self.flush()
+
+    async def wait_durable(self):
+        """Flush and wait until everything written so far is on disk"""
+        self.flush()
+        await asyncio.wrap_future(file_writer.barrier())
+
+    def start(self):
+        """Start the periodic flush task"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.periodic_flush()
+            except Exception as e:
+                print(f"Error flushing bot data: {e}")
+
+class DataStore(WriteBehindStore):
+    """In-memory bot data with write-behind flushing
+
+    Global sections (users, meta) live in DATA_FILE. Tickets, polls and
+    warnings are partitioned into one JSON file per guild under GUILD_DATA_DIR
+    and levels into a binary LevelTable file next to it, loaded the first time
+    the guild is touched and evicted once idle.
+    XP gains are appended to an XP journal and folded into the level files on
+    compaction; every level file records the last journal sequence it contains.
+    """
+
+    def __init__(self, path, guild_dir=GUILD_DATA_DIR, journal_path=XP_JOURNAL_FILE, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.guild_dir = guild_dir
+        self.archive_dir = os.path.join(guild_dir, 'archive')
+        self.journal_path = journal_path
+        self._data = None
+        self.dirty_sections = set()
+        self.partitions = {}  # {guild_key: partition}
+        self.partition_access = {}  # {guild_key: last access time}
+        self.dirty_guilds = set()
+        self.pending_journal = {}  # {guild_key: [(seq, user_key, amount)]} for guilds not loaded yet
+        self.journal_guilds = set()  # loaded guilds with XP not yet written to their file
+        self.archived_guilds = set()  # guilds the bot left; nothing is written for them until restored
+        self.partition_writes = {}  # {guild_key: future of the last queued write}
+        self.retired_journals = []
+        self._journal = None
+        self.journal_seq = 0
+        self.journal_entries = 0
+        self.last_compaction = time.time()
+
+    @property
+    def data(self):
+        """Resident global data dict, loaded from disk on first access"""
+        if self._data is None:
+            self.load()
+        return self._data
+
+    def load(self):
+        """Load DATA_FILE once into memory; guild partitions load lazily"""
+        os.makedirs(self.guild_dir, exist_ok=True)
+        data = read_json_snapshot(self.path) or {}
+        for section in DATA_SECTIONS:
+            data.setdefault(section, {})
+        self._data = data
+        self.dirty_sections.clear()
+        self.partitions.clear()
+        self.partition_access.clear()
+        self.dirty_guilds.clear()
+        self.pending_journal.clear()
+        self.journal_guilds.clear()
+        self.partition_writes.clear()
+        self.pending_mutations = 0
+        self.journal_seq = data['meta'].get('xp_journal_seq', 0)
+        self.journal_entries = 0
+        self.archived_guilds = set(data['meta'].get('archived_guilds', []))
+        # Replay first so guilds split out of a legacy file get their journaled XP
+        self.replay_journal()
+        self._split_legacy_sections()
+
+    def _split_legacy_sections(self):
+        """Move guild sections of a single-file bot_data.json into per-guild files"""
+        legacy = {section: self._data.pop(section) for section in GUILD_SECTIONS if section in self._data}
+        if not legacy:
+            return
+        raw_partitions = {}
+        def raw_for(guild_key):
+            return raw_partitions.setdefault(guild_key, {'tickets': {}, 'polls': {}, 'warnings': {}})
+
+        for guild_key, levels in legacy.get('user_levels', {}).items():
+            raw_for(guild_key)['user_levels'] = levels
+        for guild_key, warnings in legacy.get('warnings', {}).items():
+            raw_for(guild_key)['warnings'] = warnings
+        for ticket_id, ticket in legacy.get('tickets', {}).items():
+            raw_for(str(ticket['guild_id']))['tickets'][ticket_id] = ticket
+        for poll_id, poll in legacy.get('polls', {}).items():
+            raw_for(str(poll['guild_id']))['polls'][poll_id] = poll
+
+        self._data['meta'].setdefault('ticket_seq', max(map(int, legacy.get('tickets', {})), default=0))
+        snapshot_seq = self._data['meta'].get('xp_journal_seq', 0)
+        for guild_key, raw in raw_partitions.items():
+            partition = self._decode_partition(raw)
+            partition['xp_journal_seq'] = snapshot_seq
+            self._apply_pending_journal(guild_key, partition)
+            # Every journal record of the guild is folded in now
+            partition['xp_journal_seq'] = self.journal_seq
+            # Stay resident until the queued write lands so reads never see a missing file
+            self.partitions[guild_key] = partition
+            self.partition_access[guild_key] = time.time()
+            self.partition_writes[guild_key] = self._write_partition_file(guild_key, partition)
+        self.dirty_sections.add('meta')
+        self.flush()
+        print(f"Split {self.path} into {len(raw_partitions)} guild partitions")
+
+    @staticmethod
+    def _empty_partition():
+        partition = {section: {} for section in GUILD_SECTIONS}
+        partition['user_levels'] = LevelTable()
+        partition['xp_journal_seq'] = 0
+        return partition
+
+    @classmethod
+    def _decode_partition(cls, raw):
+        """Partition from a guild file's JSON, dropping records that fail validation"""
+        partition = cls._empty_partition()
+        partition['tickets'] = _decode_records(raw.get('tickets', {}), Ticket.from_dict, 'ticket')
+        partition['polls'] = _decode_records(raw.get('polls', {}), Poll.from_dict, 'poll')
+        partition['warnings'] = _decode_records(
+            raw.get('warnings', {}),
+            lambda user_key, warning_data: [WarningRecord.from_dict(warning) for warning in warning_data['history']],
+            'warning history')
+        if 'user_levels' in raw:
+            # Levels written before they moved to their own file
+            partition['user_levels'] = LevelTable.from_dict(raw['user_levels'])
+        partition['xp_journal_seq'] = raw.get('xp_journal_seq', 0)
+        return partition
+
+    @staticmethod
+    def _encode_partition(partition):
+        """A partition's JSON sections in the legacy string-keyed layout"""
+        return {
+            'tickets': {str(ticket_id): ticket.to_dict() for ticket_id, ticket in partition['tickets'].items()},
+            'polls': {str(poll_id): poll.to_dict() for poll_id, poll in partition['polls'].items()},
+            'warnings': {
+                str(user_id): {'count': len(history), 'history': [warning.to_dict() for warning in history]}
+                for user_id, history in partition['warnings'].items()
+            }
+        }
+
+    def _partition_path(self, guild_key):
+        return os.path.join(self.guild_dir, f'{guild_key}.json')
+
+    def _levels_path(self, guild_key):
+        return os.path.join(self.guild_dir, f'{guild_key}.levels')
+
+    def _read_partition(self, guild_key, directory):
+        """Decode a guild's files in directory, and whether its levels still need the binary format"""
+        raw = read_json_snapshot(os.path.join(directory, f'{guild_key}.json')) or {}
+        partition = self._decode_partition(raw)
+        levels = read_snapshot(os.path.join(directory, f'{guild_key}.levels'), LevelTable.from_bytes)
+        if levels is not None:
+            partition['user_levels'], partition['xp_journal_seq'] = levels
+        return partition, levels is None and 'user_levels' in raw
+
+    def _partition(self, guild_id):
+        """Guild partition, loaded from its file on first use"""
+        guild_key = str(guild_id)
+        partition = self.partitions.get(guild_key)
+        if partition is None:
+            if guild_key in self.archived_guilds:
+                # A throwaway view, so nothing re-creates the guild's files before restore_guild
+                return self._empty_partition()
+            partition, legacy_levels = self._read_partition(guild_key, self.guild_dir)
+            if legacy_levels:
+                self.dirty_guilds.add(guild_key)  # Rewrite the levels in the binary format
+            self.partitions[guild_key] = partition
+            self._apply_pending_journal(guild_key, partition)
+        self.partition_access[guild_key] = time.time()
+        return partition
+
+    def _apply_pending_journal(self, guild_key, partition):
+        """Apply queued journal records newer than the partition's snapshot"""
+        for seq, user_key, amount in self.pending_journal.pop(guild_key, ()):
+            if seq > partition['xp_journal_seq']:
+                self._apply_experience(partition, user_key, amount)
+                self.journal_guilds.add(guild_key)
+
+    def replay_journal(self):
+        """Queue XP journal records for replay when their guild is loaded"""
+        # Journals retired by a compaction whose writes never landed come first
+        self.retired_journals = sorted(glob.glob(f'{glob.escape(self.journal_path)}.*'),
+                                       key=lambda path: int(path.rsplit('.', 1)[1]))
+        replayed = 0
+        for path in self.retired_journals + [self.journal_path]:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break  # Torn tail from a crash mid-append
+                    try:
+                        seq, guild_key, user_key, amount = line.split()
+                        seq = int(seq)
+                        amount = int(amount)
+                    except ValueError:
+                        break
+                    self.journal_seq = max(self.journal_seq, seq)
+                    if guild_key in self.archived_guilds:
+                        continue  # Already folded into the archived files
+                    self.pending_journal.setdefault(guild_key, []).append((seq, user_key, amount))
+                    replayed += 1
+        if replayed:
+            print(f"Queued {replayed} XP journal records for replay")
+            self.journal_entries = replayed
+
+    def mark_dirty(self, section, guild_key=None):
+        if guild_key is None:
+            self.dirty_sections.add(section)
+        elif guild_key not in self.archived_guilds:
+            self.dirty_guilds.add(guild_key)
+        super().mark_dirty(section)
+
+    def flush(self, compact=False):
+        """Write changed global data and guild partitions to disk"""
+        if self._data is None:
+            return
+        if self._journal is not None:
+            self._journal.flush()
+        compact = bool(self.journal_entries) and (
+            compact or time.time() - self.last_compaction >= XP_JOURNAL_COMPACT_INTERVAL)
+        if compact:
+            for guild_key in list(self.pending_journal):
+                self._partition(guild_key)
+            self.dirty_guilds |= self.journal_guilds
+            self.dirty_sections.add('meta')
+
+        # Global file first so the journal sequence never goes backwards
+        if self.dirty_sections:
+            self._data['meta']['xp_journal_seq'] = self.journal_seq
+            file_writer.write(self.path, json.dumps(self._data, ensure_ascii=False, indent=2), backup=True)
+            self.dirty_sections.clear()
+        for guild_key in list(self.dirty_guilds):
+            self._write_partition(guild_key)
+        self.pending_mutations = 0
+        if compact:
+            self._rotate_journal()
+
+
+    def _write_partition(self, guild_key):
+        partition = self.partitions[guild_key]
+        # A loaded partition holds every journal record up to journal_seq
+        partition['xp_journal_seq'] = self.journal_seq
+        self.partition_writes[guild_key] = self._write_partition_file(guild_key, partition)
+        self.dirty_guilds.discard(guild_key)
+        self.journal_guilds.discard(guild_key)
+
+    def _write_partition_file(self, guild_key, partition):
+        """Queue the partition's JSON and level files; the returned future covers both"""
+        payload = json.dumps(self._encode_partition(partition), ensure_ascii=False, separators=(',', ':'))
+        file_writer.write(self._partition_path(guild_key), payload, backup=True)
+        levels = partition['user_levels'].to_bytes(partition['xp_journal_seq'])
+        return file_writer.write(self._levels_path(guild_key), levels, backup=True)
+
+    def compact(self):
+        """Fold the XP journal into the guild partitions"""
+        self.flush(compact=True)
+
+    def periodic_flush(self):
+        self.flush()
+        self.evict_idle()
+
+    def evict_idle(self, max_idle=GUILD_PARTITION_IDLE_TTL):
+        """Drop clean guild partitions that have not been touched recently"""
+        cutoff = time.time() - max_idle
+        for guild_key, last_access in list(self.partition_access.items()):
+            write = self.partition_writes.get(guild_key)
+            if (last_access < cutoff and guild_key not in self.dirty_guilds
+                    and guild_key not in self.journal_guilds and (write is None or write.done())):
+                del self.partitions[guild_key]
+                del self.partition_access[guild_key]
+                self.partition_writes.pop(guild_key, None)
+
+    async def archive_guild(self, guild_id):
+        """Move a guild's partition into the archive directory in one step
+
+        The partition is written with all of the guild's journal records first,
+        and the guild is marked archived in the global file ahead of the move,
+        so a restart skips its journal records instead of replaying them into
+        a fresh partition that would shadow the archive.
+        """
+        guild_key = str(guild_id)
+        if guild_key in self.partitions or guild_key in self.pending_journal:
+            self._partition(guild_key)
+            self._write_partition(guild_key)
+            del self.partitions[guild_key]
+            del self.partition_access[guild_key]
+            self.partition_writes.pop(guild_key, None)
+        self.archived_guilds.add(guild_key)
+        self._save_archived_guilds()
+        self.flush()
+        await asyncio.wrap_future(file_writer.call(self._move_partition, guild_key, self.guild_dir, self.archive_dir))
+
+    async def restore_guild(self, guild_id):
+        """Bring an archived guild partition back into use
+
+        A partition re-created while the guild was archived is merged with the
+        archived one instead of leaving the archive orphaned.
+        """
+        guild_key = str(guild_id)
+        if guild_key in self.archived_guilds:
+            self.archived_guilds.discard(guild_key)
+            self._save_archived_guilds()
+            self.flush()
+        archived_paths = [os.path.join(self.archive_dir, guild_key + suffix) for suffix in ('.json', '.levels')]
+        recreated = (guild_key in self.partitions or os.path.exists(self._partition_path(guild_key))
+                     or os.path.exists(self._levels_path(guild_key)))
+        if recreated and any(map(os.path.exists, archived_paths)):
+            partition = self._partition(guild_key)
+            self._merge_partition(partition, self._read_partition(guild_key, self.archive_dir)[0])
+            self._write_partition(guild_key)
+            await asyncio.wrap_future(file_writer.call(_remove_files, archived_paths))
+        else:
+            await asyncio.wrap_future(file_writer.call(self._move_partition, guild_key, self.archive_dir, self.guild_dir))
+
+    def _save_archived_guilds(self):
+        self.data['meta']['archived_guilds'] = sorted(self.archived_guilds)
+        self.mark_dirty('meta')
+
+    @staticmethod
+    def _merge_partition(partition, archived):
+        """Fold an archived partition into one re-created after it was archived"""
+        levels = partition['user_levels']
+        for user_id, total_xp in zip(archived['user_levels'].user_ids, archived['user_levels'].total_xp):
+            # A re-created partition replayed journal records the archive already holds,
+            # so keep the higher total rather than adding the two
+            current = levels.get(user_id)
+            gap = total_xp - (current['total_xp'] if current else 0)
+            if gap > 0:
+                levels.add(user_id, gap)
+        for section in ('tickets', 'polls'):
+            partition[section] = {**archived[section], **partition[section]}
+        for user_id, history in archived['warnings'].items():
+            partition['warnings'][user_id] = history + partition['warnings'].get(user_id, [])
+
+    @staticmethod
+    def _move_partition(guild_key, source_dir, destination_dir):
+        for suffix in ('.json', '.levels'):
+            source = os.path.join(source_dir, guild_key + suffix)
+            destination = os.path.join(destination_dir, guild_key + suffix)
+            if os.path.exists(source) and not os.path.exists(destination):
+                os.makedirs(destination_dir, exist_ok=True)
+                os.replace(source, destination)
+
+    def _append_journal(self, guild_key, user_key, amount):
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.journal_seq += 1
+        self._journal.write(f'{self.journal_seq} {guild_key} {user_key} {amount}\n')
+        self.journal_entries += 1
+        self.journal_guilds.add(guild_key)
+        if self.journal_entries >= XP_JOURNAL_COMPACT_THRESHOLD:
+            self.compact()
+
+    def _rotate_journal(self):
+        """Retire the current journal and delete it once the queued snapshot writes land"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self.journal_path):
+            retired = f'{self.journal_path}.{self.journal_seq}'
+            os.replace(self.journal_path, retired)
+            self.retired_journals.append(retired)
+        for retired in self.retired_journals:
+            file_writer.call(os.remove, retired)
+        self.retired_journals = []
+        self.journal_entries = 0
+        self.last_compaction = time.time()
+
+    def export_data(self):
+        """Whole dataset in the single-file bot_data.json layout"""
+        data = {'users': self.data['users'], 'meta': dict(self.data['meta']),
+                'user_levels': {}, 'tickets': {}, 'polls': {}, 'warnings': {}}
+        guild_keys = set(self.partitions) | set(self.pending_journal)
+        if os.path.isdir(self.guild_dir):
+            guild_keys.update(name[:-len('.json')] for name in os.listdir(self.guild_dir) if name.endswith('.json'))
+        for guild_key in guild_keys:
+            partition = self._partition(guild_key)
+            sections = self._encode_partition(partition)
+            data['user_levels'][guild_key] = partition['user_levels'].to_dict()
+            data['warnings'][guild_key] = sections['warnings']
+            data['tickets'].update(sections['tickets'])
+            data['polls'].update(sections['polls'])
+        return data
+
+    # Users
+    def get_user(self, user_id):
+        return self.data['users'].get(str(user_id))
+
+    def authenticate_user(self, user_id, server_link_auth=False):
+        users = self.data['users']
+        user_key = str(user_id)
+        if user_key not in users:
+            users[user_key] = {
+                'authenticated': True,
+                'join_date': datetime.now().isoformat()
+            }
+        else:
+            users[user_key]['authenticated'] = True
+        if server_link_auth:
+            users[user_key]['server_link_auth'] = True
+        self.mark_dirty('users')
+
+    # Levels
+    def get_level(self, guild_id, user_id):
+        return self._partition(guild_id)['user_levels'].get(user_id)
+
+    def add_experience(self, guild_id, user_id, amount):
+        guild_key = str(guild_id)
+        user_key = str(user_id)
+        if guild_key in self.archived_guilds:
+            return None  # XP that was still batched when the bot left
+        new_level = self._apply_experience(self._partition(guild_key), user_key, amount)
+        self._append_journal(guild_key, user_key, amount)
+        return new_level
+
+    @staticmethod
+    def _apply_experience(partition, user_key, amount):
+        old_total, new_total = partition['user_levels'].add(user_key, amount)
+        new_level = level_from_total_xp(new_total)[0]
+        if new_level > level_from_total_xp(old_total)[0]:
+            return new_level
+        return None
+
+    def top_levels(self, guild_id, limit, offset=0):
+        return self._partition(guild_id)['user_levels'].top(limit, offset)
+
+    def level_rank(self, guild_id, user_id):
+        return self._partition(guild_id)['user_levels'].rank(user_id)
+
+    def level_count(self, guild_id):
+        return len(self._partition(guild_id)['user_levels'])
+
+    def level_guilds(self):
+        """Keys of every guild with a level table, loaded or not"""
+        guild_keys = set(self.partitions) | set(self.pending_journal)
+        if os.path.isdir(self.guild_dir):
+            guild_keys.update(name[:-len('.levels')] for name in os.listdir(self.guild_dir) if name.endswith('.levels'))
+        return guild_keys
+
+    def level_version(self, guild_id):
+        """Token that changes whenever a guild's levels may have changed"""
+        guild_key = str(guild_id)
+        if guild_key in self.pending_journal:
+            self._partition(guild_key)
+        partition = self.partitions.get(guild_key)
+        if partition is not None:
+            return partition['user_levels'].version
+        # An idle guild may have been loaded, changed and evicted since the last call,
+        # so identify the .levels file itself (every atomic rewrite is a new inode)
+        try:
+            stat = os.stat(self._levels_path(guild_key))
+        except OSError:
+            return None
+        return ('disk', stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def guild_top_levels(self, guild_id, limit):
+        """(user_id, total_xp) of a guild's top users; idle guilds are read without being loaded"""
+        guild_key = str(guild_id)
+        if guild_key in self.pending_journal:
+            self._partition(guild_key)
+        partition = self.partitions.get(guild_key)
+        if partition is not None:
+            return partition['user_levels'].top_totals(limit)
+        levels = read_snapshot(self._levels_path(guild_key), LevelTable.from_bytes)
+        return levels[0].top_totals(limit) if levels else []
+
+    # Polls
+    def create_poll(self, poll):
+        self._partition(poll.guild_id)['polls'][poll.poll_id] = poll
+        self.mark_dirty('polls', str(poll.guild_id))
+
+    def get_poll(self, guild_id, poll_id):
+        return self._partition(guild_id)['polls'].get(int(poll_id))
+
+    def record_vote(self, guild_id, poll_id, user_id, option_index):
+        """Record or move a user's vote, returning the updated poll"""
+        if not str(poll_id).isdigit():
+            return None
+        poll = self.get_poll(guild_id, poll_id)
+        if poll is None:
+            return None
+        poll.vote(user_id, option_index)
+        self.mark_dirty('polls', str(guild_id))
+        return poll
+
+    # Tickets
+    def next_ticket_id(self):
+        meta = self.data['meta']
+        meta['ticket_seq'] = meta.get('ticket_seq', 0) + 1
+        self.mark_dirty('meta')
+        return meta['ticket_seq']
+
+    def create_ticket(self, ticket):
+        self._partition(ticket.guild_id)['tickets'][ticket.ticket_id] = ticket
+        self.mark_dirty('tickets', str(ticket.guild_id))
+
+    def get_ticket(self, guild_id, ticket_id):
+        return self._partition(guild_id)['tickets'].get(int(ticket_id))
+
+    def close_ticket(self, guild_id, ticket_id, closed_by):
+        self.get_ticket(guild_id, ticket_id).close(closed_by)
+        self.mark_dirty('tickets', str(guild_id))
+
+    def _guild_tickets(self, guild_id, status=None):
+        for ticket in self._partition(guild_id)['tickets'].values():
+            if status is None or ticket.status == status:
+                yield ticket
+
+    def list_tickets(self, guild_id, status=None, limit=None):
+        tickets = self._guild_tickets(guild_id, status)
+        return list(tickets if limit is None else itertools.islice(tickets, limit))
+
+    def count_tickets(self, guild_id, status=None):
+        return sum(1 for _ in self._guild_tickets(guild_id, status))
+
+    # Warnings
+    def get_warnings(self, guild_id, user_id, limit=None):
+        """Warning count and the most recent history entries, or None"""
+        history = self._partition(guild_id)['warnings'].get(int(user_id))
+        if not history:
+            return None
+        count = len(history)
+        if limit is not None:
+            history = history[max(count - limit, 0):]
+        return {'count': count, 'history': list(history)}
+
+    def add_warning(self, guild_id, user_id, reason, moderator_id):
+        history = self._partition(guild_id)['warnings'].setdefault(int(user_id), [])
+        history.append(WarningRecord(reason, int(moderator_id), datetime.now().isoformat()))
+        self.mark_dirty('warnings', str(guild_id))
+        return len(history)
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    authenticated INTEGER NOT NULL DEFAULT 0,
+    join_date TEXT,
+    server_link_auth INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS user_levels (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    xp INTEGER NOT NULL,
+    total_xp INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_user_levels_guild_xp ON user_levels (guild_id, total_xp);
+CREATE TABLE IF NOT EXISTS tickets (
+    ticket_id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    channel_id INTEGER,
+    created_at TEXT,
+    description TEXT,
+    status TEXT NOT NULL,
+    closed_at TEXT,
+    closed_by INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_tickets_guild_status ON tickets (guild_id, status);
+CREATE TABLE IF NOT EXISTS polls (
+    poll_id INTEGER PRIMARY KEY,
+    guild_id INTEGER,
+    channel_id INTEGER,
+    question TEXT NOT NULL,
+    options TEXT NOT NULL,
+    creator TEXT
+);
+CREATE TABLE IF NOT EXISTS poll_votes (
+    poll_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    option_index INTEGER NOT NULL,
+    PRIMARY KEY (poll_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS warnings (
+    warning_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    reason TEXT,
+    moderator_id INTEGER,
+    timestamp TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_warnings_guild_user ON warnings (guild_id, user_id);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+class SqliteDataStore(WriteBehindStore):
+    """SQLite (WAL) bot data; queries only touch the rows they need"""
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.conn = None
+
+    @property
+    def db(self):
+        if self.conn is None:
+            self.load()
+        return self.conn
+
+    def connect(self):
+        """Open the database in WAL mode and create missing tables"""
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SQLITE_SCHEMA)
+
+    def load(self):
+        """Open the database, migrating DATA_FILE on first use"""
+        if self.conn is not None:
+            return
+        is_new = not os.path.exists(self.path)
+        self.connect()
+        if is_new and os.path.exists(DATA_FILE):
+            print(f"Migrating {DATA_FILE} to {self.path}...")
+            self.import_data(DataStore(DATA_FILE).export_data())
+
+    def flush(self):
+        """Commit the pending transaction"""
+        if self.conn is not None and self.conn.in_transaction:
+            self.conn.commit()
+        self.pending_mutations = 0
+
+    def import_data(self, data):
+        """Bulk insert a bot_data.json dict in one transaction"""
+        db = self.db
+        db.executemany(
+            'INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)',
+            ((int(user_id), int(bool(user.get('authenticated'))), user.get('join_date'),
+              int(bool(user.get('server_link_auth'))))
+             for user_id, user in data.get('users', {}).items())
+        )
+        db.executemany(
+            'INSERT OR REPLACE INTO user_levels VALUES (?, ?, ?, ?, ?)',
+            ((int(guild_id), int(user_id), level_data['level'], level_data['xp'], level_data['total_xp'])
+             for guild_id, guild_levels in data.get('user_levels', {}).items()
+             for user_id, level_data in guild_levels.items())
+        )
+        db.executemany(
+            'INSERT OR REPLACE INTO tickets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((int(ticket_id), int(ticket['guild_id']), int(ticket['user_id']), _optional_int(ticket.get('channel_id')),
+              ticket.get('created_at'), ticket.get('description'), ticket['status'],
+              ticket.get('closed_at'), _optional_int(ticket.get('closed_by')))
+             for ticket_id, ticket in data.get('tickets', {}).items())
+        )
+        polls = [(poll_id, poll) for poll_id, poll in data.get('polls', {}).items() if poll_id.isdigit()]
+        db.executemany(
+            'INSERT OR REPLACE INTO polls VALUES (?, ?, ?, ?, ?, ?)',
+            ((int(poll_id), poll.get('guild_id'), poll.get('channel_id'), poll['question'],
+              json.dumps(poll['options'], ensure_ascii=False), poll.get('creator'))
+             for poll_id, poll in polls)
+        )
+        db.executemany(
+            'INSERT OR REPLACE INTO poll_votes VALUES (?, ?, ?)',
+            ((int(poll_id), int(user_id), option_index)
+             for poll_id, poll in polls
+             for user_id, option_index in poll.get('voters', {}).items())
+        )
+        db.executemany(
+            'INSERT INTO warnings (guild_id, user_id, reason, moderator_id, timestamp) VALUES (?, ?, ?, ?, ?)',
+            ((int(guild_id), int(user_id), warning.get('reason'), _optional_int(warning.get('moderator_id')),
+              warning.get('timestamp'))
+             for guild_id, guild_warnings in data.get('warnings', {}).items()
+             for user_id, warning_data in guild_warnings.items()
+             for warning in warning_data.get('history', []))
+        )
+        if 'ticket_seq' in data.get('meta', {}):
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('ticket_seq', ?)", (int(data['meta']['ticket_seq']),))
+        db.commit()
+
+    # Users
+    def get_user(self, user_id):
+        row = self.db.execute('SELECT * FROM users WHERE user_id = ?', (int(user_id),)).fetchone()
+        if row is None:
+            return None
+        return {
+            'authenticated': bool(row['authenticated']),
+            'join_date': row['join_date'],
+            'server_link_auth': bool(row['server_link_auth'])
+        }
+
+    def authenticate_user(self, user_id, server_link_auth=False):
+        self.db.execute(
+            'INSERT INTO users (user_id, authenticated, join_date, server_link_auth) VALUES (?, 1, ?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET authenticated = 1, '
+            'server_link_auth = MAX(server_link_auth, excluded.server_link_auth)',
+            (int(user_id), datetime.now().isoformat(), int(server_link_auth))
+        )
+        self.mark_dirty('users')
+
+    # Levels
+    def get_level(self, guild_id, user_id):
+        row = self.db.execute(
+            'SELECT level, xp, total_xp FROM user_levels WHERE guild_id = ? AND user_id = ?',
+            (int(guild_id), int(user_id))
+        ).fetchone()
+        return dict(row) if row else None
+
+    def add_experience(self, guild_id, user_id, amount):
+        old = self.get_level(guild_id, user_id) or {'level': 1, 'total_xp': 0}
+        total_xp = old['total_xp'] + amount
+        new_level, xp = level_from_total_xp(total_xp)
+        level = max(new_level, old['level'])
+        self.db.execute(
+            'INSERT OR REPLACE INTO user_levels (guild_id, user_id, level, xp, total_xp) VALUES (?, ?, ?, ?, ?)',
+            (int(guild_id), int(user_id), level, xp, total_xp)
+        )
+        self.mark_dirty('user_levels')
+        return new_level if new_level > old['level'] else None
+
+    def top_levels(self, guild_id, limit, offset=0):
+        rows = self.db.execute(
+            'SELECT user_id, level, xp, total_xp FROM user_levels WHERE guild_id = ? '
+            'ORDER BY total_xp DESC, user_id LIMIT ? OFFSET ?',
+            (int(guild_id), limit, offset)
+        ).fetchall()
+        return [(row['user_id'], {'level': row['level'], 'xp': row['xp'], 'total_xp': row['total_xp']}) for row in rows]
+
+    def level_count(self, guild_id):
+        return self.db.execute('SELECT COUNT(*) FROM user_levels WHERE guild_id = ?', (int(guild_id),)).fetchone()[0]
+
+    def level_guilds(self):
+        return [row[0] for row in self.db.execute('SELECT DISTINCT guild_id FROM user_levels')]
+
+    def level_version(self, guild_id):
+        return None  # No cheap change marker; views are re-queried on every refresh
+
+    def guild_top_levels(self, guild_id, limit):
+        return self.db.execute(
+            'SELECT user_id, total_xp FROM user_levels WHERE guild_id = ? ORDER BY total_xp DESC, user_id LIMIT ?',
+            (int(guild_id), limit)
+        ).fetchall()
+
+    def level_rank(self, guild_id, user_id):
+        level_data = self.get_level(guild_id, user_id)
+        if level_data is None:
+            return None
+        total_xp = level_data['total_xp']
+        return self.db.execute(
+            'SELECT COUNT(*) + 1 FROM user_levels WHERE guild_id = ? '
+            'AND (total_xp > ? OR (total_xp = ? AND user_id < ?))',
+            (int(guild_id), total_xp, total_xp, int(user_id))
+        ).fetchone()[0]
+
+    # Polls
+    def create_poll(self, poll):
+        self.db.execute(
+            'INSERT OR REPLACE INTO polls VALUES (?, ?, ?, ?, ?, ?)',
+            (poll.poll_id, poll.guild_id, poll.channel_id, poll.question,
+             json.dumps(poll.options, ensure_ascii=False), poll.creator)
+        )
+        self.mark_dirty('polls')
+
+    def get_poll(self, guild_id, poll_id):
+        row = self.db.execute(
+            'SELECT * FROM polls WHERE poll_id = ? AND guild_id = ?', (int(poll_id), int(guild_id))
+        ).fetchone()
+        if row is None:
+            return None
+        options = json.loads(row['options'])
+        votes = [0] * len(options)
+        for option_index, count in self.db.execute(
+                'SELECT option_index, COUNT(*) FROM poll_votes WHERE poll_id = ? GROUP BY option_index',
+                (int(poll_id),)):
+            votes[option_index] = count
+        return Poll(row['poll_id'], row['guild_id'], row['channel_id'], row['question'], options, row['creator'], votes)
+
+    def record_vote(self, guild_id, poll_id, user_id, option_index):
+        if not str(poll_id).isdigit():
+            return None
+        exists = self.db.execute(
+            'SELECT 1 FROM polls WHERE poll_id = ? AND guild_id = ?', (int(poll_id), int(guild_id))
+        ).fetchone()
+        if exists is None:
+            return None
+        self.db.execute(
+            'INSERT OR REPLACE INTO poll_votes (poll_id, user_id, option_index) VALUES (?, ?, ?)',
+            (int(poll_id), int(user_id), option_index)
+        )
+        self.mark_dirty('polls')
+        return self.get_poll(guild_id, poll_id)
+
+    # Tickets
+    def next_ticket_id(self):
+        """Reserve a ticket ID; the counter starts after any tickets that predate it"""
+        db = self.db
+        db.execute(
+            "INSERT INTO meta VALUES ('ticket_seq', (SELECT COALESCE(MAX(ticket_id), 0) + 1 FROM tickets)) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + 1"
+        )
+        self.mark_dirty('meta')
+        return db.execute("SELECT value FROM meta WHERE name = 'ticket_seq'").fetchone()[0]
+
+    def create_ticket(self, ticket):
+        self.db.execute(
+            'INSERT OR REPLACE INTO tickets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (ticket.ticket_id, ticket.guild_id, ticket.user_id, ticket.channel_id, ticket.created_at,
+             ticket.description, ticket.status, ticket.closed_at, ticket.closed_by)
+        )
+        self.mark_dirty('tickets')
+
+    @staticmethod
+    def _ticket_from_row(row):
+        return Ticket(row['ticket_id'], row['guild_id'], row['user_id'], row['channel_id'], row['created_at'],
+                      row['description'], row['status'], row['closed_at'], row['closed_by'])
+
+    def get_ticket(self, guild_id, ticket_id):
+        row = self.db.execute(
+            'SELECT * FROM tickets WHERE ticket_id = ? AND guild_id = ?', (int(ticket_id), int(guild_id))
+        ).fetchone()
+        return self._ticket_from_row(row) if row else None
+
+    def close_ticket(self, guild_id, ticket_id, closed_by):
+        self.db.execute(
+            "UPDATE tickets SET status = 'closed', closed_at = ?, closed_by = ? WHERE ticket_id = ? AND guild_id = ?",
+            (datetime.now().isoformat(), int(closed_by), int(ticket_id), int(guild_id))
+        )
+        self.mark_dirty('tickets')
+
+    def list_tickets(self, guild_id, status=None, limit=None):
+        query = 'SELECT * FROM tickets WHERE guild_id = ?'
+        params = [int(guild_id)]
+        if status is not None:
+            query += ' AND status = ?'
+            params.append(status)
+        query += ' ORDER BY ticket_id LIMIT ?'
+        params.append(-1 if limit is None else limit)
+        return [self._ticket_from_row(row) for row in self.db.execute(query, params)]
+
+    def count_tickets(self, guild_id, status=None):
+        if status is None:
+            return self.db.execute('SELECT COUNT(*) FROM tickets WHERE guild_id = ?', (int(guild_id),)).fetchone()[0]
+        return self.db.execute(
+            'SELECT COUNT(*) FROM tickets WHERE guild_id = ? AND status = ?', (int(guild_id), status)
+        ).fetchone()[0]
+
+    # Warnings
+    def get_warnings(self, guild_id, user_id, limit=None):
+        key = (int(guild_id), int(user_id))
+        count = self.db.execute('SELECT COUNT(*) FROM warnings WHERE guild_id = ? AND user_id = ?', key).fetchone()[0]
+        if count == 0:
+            return None
+        rows = self.db.execute(
+            'SELECT reason, moderator_id, timestamp FROM warnings WHERE guild_id = ? AND user_id = ? '
+            'ORDER BY warning_id DESC LIMIT ?',
+            (*key, -1 if limit is None else limit)
+        ).fetchall()
+        return {'count': count, 'history': [self._warning_from_row(row) for row in reversed(rows)]}
+
+    @staticmethod
+    def _warning_from_row(row):
+        return WarningRecord(row['reason'], row['moderator_id'], row['timestamp'])
+
+    def add_warning(self, guild_id, user_id, reason, moderator_id):
+        self.db.execute(
+            'INSERT INTO warnings (guild_id, user_id, reason, moderator_id, timestamp) VALUES (?, ?, ?, ?, ?)',
+            (int(guild_id), int(user_id), reason, int(moderator_id), datetime.now().isoformat())
+        )
+        self.mark_dirty('warnings')
+        return self.db.execute(
+            'SELECT COUNT(*) FROM warnings WHERE guild_id = ? AND user_id = ?', (int(guild_id), int(user_id))
+        ).fetchone()[0]
+
+    async def archive_guild(self, guild_id):
+        """Export a guild's rows to the archive directory, then delete them in one transaction"""
+        guild_key = str(guild_id)
+        db = self.db
+        params = (int(guild_id),)
+        polls = {}
+        for row in db.execute('SELECT * FROM polls WHERE guild_id = ?', params):
+            poll = self.get_poll(guild_id, row['poll_id'])
+            poll.voters = dict(db.execute(
+                'SELECT user_id, option_index FROM poll_votes WHERE poll_id = ?', (row['poll_id'],)))
+            polls[str(row['poll_id'])] = poll.to_dict()
+        warnings = {}
+        for row in db.execute('SELECT * FROM warnings WHERE guild_id = ? ORDER BY warning_id', params):
+            warning_data = warnings.setdefault(str(row['user_id']), {'count': 0, 'history': []})
+            warning_data['count'] += 1
+            warning_data['history'].append(self._warning_from_row(row).to_dict())
+        archive = {
+            'user_levels': {guild_key: {
+                str(row['user_id']): {'level': row['level'], 'xp': row['xp'], 'total_xp': row['total_xp']}
+                for row in db.execute('SELECT * FROM user_levels WHERE guild_id = ?', params)
+            }},
+            'tickets': {
+                str(row['ticket_id']): self._ticket_from_row(row).to_dict()
+                for row in db.execute('SELECT * FROM tickets WHERE guild_id = ?', params)
+            },
+            'polls': polls,
+            'warnings': {guild_key: warnings}
+        }
+        archive_dir = os.path.join(GUILD_DATA_DIR, 'archive')
+        os.makedirs(archive_dir, exist_ok=True)
+        # The rows may only go once the archive is on disk; a failed write raises here
+        await asyncio.wrap_future(file_writer.write(os.path.join(archive_dir, f'{guild_key}.sqlite.json'),
+                                                    json.dumps(archive, ensure_ascii=False, separators=(',', ':'))))
+        with db:
+            db.execute('DELETE FROM poll_votes WHERE poll_id IN (SELECT poll_id FROM polls WHERE guild_id = ?)', params)
+            for table in ('user_levels', 'tickets', 'polls', 'warnings'):
+                db.execute(f'DELETE FROM {table} WHERE guild_id = ?', params)
+
+    async def restore_guild(self, guild_id):
+        """Re-import an archived guild; the file is read and removed on the writer thread"""
+        archive_path = os.path.join(GUILD_DATA_DIR, 'archive', f'{guild_id}.sqlite.json')
+        archive = await asyncio.wrap_future(file_writer.call(read_json_snapshot, archive_path))
+        if archive is None:
+            return
+        # The connection belongs to the event loop thread, so the (single guild) import runs here
+        self.import_data(archive)
+        await asyncio.wrap_future(file_writer.call(_remove_files, [archive_path]))
+
+def migrate_json_to_sqlite(json_path=DATA_FILE, db_path=SQLITE_FILE):
+    """One-shot migration of bot_data.json and its guild partitions into a SQLite database"""
+    data = DataStore(json_path).export_data()
+    store = SqliteDataStore(db_path)
+    store.connect()
+    store.import_data(data)
+    store.conn.close()
+    print(f"Migrated {json_path} to {db_path}")
+
+if STORAGE_BACKEND == 'sqlite':
+    data_store = SqliteDataStore(SQLITE_FILE)
+else:
+    data_store = DataStore(DATA_FILE)
+
+class ConfigSection(collections.abc.MutableMapping):
+    """One side-car config file: a {key: value} mapping with dirty tracking
+
+    Assigning or deleting a key marks it dirty, schedules a flush of this
+    section and notifies subscribers with (key, value); value is None when the
+    key was removed. normalize converts stored values (including old formats)
+    into the shape the rest of the bot expects, and encode turns them back
+    into JSON-compatible values.
+    """
+
+    def __init__(self, registry, name, path, normalize=None, encode=None):
+        self.registry = registry
+        self.name = name
+        self.path = path
+        self.normalize = normalize or (lambda value: value)
+        self.encode = encode or (lambda value: value)
+        self._values = {}
+        self.dirty_keys = set()
+        self._subscribers = []
+
+    def __getitem__(self, key):
+        return self._values[str(key)]
+
+    def __setitem__(self, key, value):
+        key = str(key)
+        value = self.normalize(value)
+        self._values[key] = value
+        self._changed(key, value)
+
+    def __delitem__(self, key):
+        key = str(key)
+        del self._values[key]
+        self._changed(key, None)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def subscribe(self, callback):
+        """Call callback(key, value) whenever a key changes"""
+        self._subscribers.append(callback)
+
+    def _changed(self, key, value):
+        self.dirty_keys.add(key)
+        self.registry.schedule_flush()
+        for callback in self._subscribers:
+            try:
+                callback(key, value)
+            except Exception as e:
+                print(f"Error in {self.name} config subscriber: {e}")
+
+    def load(self):
+        self._values = {}
+        try:
+            values = read_json_snapshot(self.path) or {}
+        except Exception as e:
+            print(f"Error loading {self.name} config: {e}")
+            values = {}
+        for key, value in values.items():
+            try:
+                self._values[str(key)] = self.normalize(value)
+            except Exception as e:
+                print(f"Skipping invalid {self.name} config {key}: {e}")
+        self.dirty_keys.clear()
+
+    def flush(self):
+        if not self.dirty_keys:
+            return None
+        self.dirty_keys.clear()
+        try:
+            values = {key: self.encode(value) for key, value in self._values.items()}
+            return file_writer.write(self.path, json.dumps(values, ensure_ascii=False, indent=2), backup=True)
+        except Exception as e:
+            print(f"Error saving {self.name} config: {e}")
+
+class ConfigRegistry:
+    """Side-car config files, loaded once in setup_hook and flushed per changed section"""
+
+    def __init__(self):
+        self.sections = {}
+        self.loaded = False
+        self._flush_handle = None
+
+    def register(self, name, path, normalize=None, encode=None):
+        section = ConfigSection(self, name, path, normalize, encode)
+        self.sections[name] = section
+        if self.loaded:
+            section.load()
+        return section
+
+    def load(self):
+        if self.loaded:
+            return
+        for section in self.sections.values():
+            section.load()
+        self.loaded = True
+
+    def schedule_flush(self):
+        """Coalesce every change made in the current loop iteration into one flush"""
+        if self._flush_handle is not None:
+            return
+        try:
+            self._flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+        except RuntimeError:
+            self.flush()
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()  # Flushed early (e.g. before a durability barrier)
+            self._flush_handle = None
+        for section in self.sections.values():
+            section.flush()
+
+config_registry = ConfigRegistry()
+
+# Persistent views storage
+def normalize_persistent_view(record):
+    if isinstance(record, PersistentViewRecord):
+        return record
+    return PersistentViewRecord.from_dict(record)
+
+persistent_views = config_registry.register('persistent_views', 'persistent_views.json',
+                                            normalize_persistent_view, PersistentViewRecord.to_dict)
 
 async def restore_persistent_views():
     """Restore persistent views after bot restart"""
-    load_persistent_views()
-    
     # Restore ticket panel views
-    for view_id, view_data in persistent_views.items():
+    for view_id, record in persistent_views.items():
         try:
-            if view_data['type'] == 'ticket_panel':
-                view = TicketPanelView(view_data.get('category_name'))
+            if record.view_type == 'ticket_panel':
+                view = TicketPanelView(record.category_name)
                 bot.add_view(view)
                 print(f"Restored TicketPanelView: {view_id}")
-            elif view_data['type'] == 'ticket_close':
-                view = TicketCloseView(view_data['ticket_id'])
+            elif record.view_type == 'ticket_close':
+                view = TicketCloseView(record.ticket_id)
                 bot.add_view(view)
-                print(f"Restored TicketCloseView for ticket {view_data['ticket_id']}")
-            elif view_data['type'] == 'public_auth':
+                print(f"Restored TicketCloseView for ticket {record.ticket_id}")
+            elif record.view_type == 'public_auth':
                 view = PublicAuthView()
                 bot.add_view(view)
                 print(f"Restored PublicAuthView: {view_id}")
-            elif view_data['type'] == 'specific_role':
-                guild = bot.get_guild(int(view_data['guild_id']))
+            elif record.view_type == 'specific_role':
+                guild = bot.get_guild(record.guild_id)
                 if guild:
-                    role = guild.get_role(int(view_data['role_id']))
+                    role = guild.get_role(record.role_id)
                     if role:
                         view = SpecificRoleView(role)
                         bot.add_view(view)
@@ -107,6 +1735,19 @@ async def restore_persistent_views():
 
 
 
+@bot.event
+async def setup_hook():
+    data_store.load()
+    config_registry.load()
+    data_store.start()
+    xp_accumulator.start()
+    start_spam_sweeper()
+    try:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+    except NotImplementedError:
+        pass
+
 @bot.event
 async def on_ready():
     print(f'{bot.user} has connected to Discord!')
@@ -115,23 +1756,12 @@ async def on_ready():
     activity = discord.Game(name=f"{server_count}サーバをプレイ中...")
     await bot.change_presence(status=discord.Status.online, activity=activity)
 
-    load_translation_config()
-    load_server_log_config()
-    load_meigen_config()
-    
     # Restore persistent views
     await restore_persistent_views()
     
     for guild_id, config in meigen_channels.items():
         if guild_id not in meigen_tasks:
-            if isinstance(config, dict):
-                channel_id = config["channel_id"]
-                interval = config["interval"]
-                task = asyncio.create_task(send_interval_meigen(guild_id, channel_id, interval))
-            else:
-                channel_id = config
-                task = asyncio.create_task(send_daily_meigen(guild_id, channel_id))
-            meigen_tasks[guild_id] = task
+            start_meigen_task(guild_id, config)
     
     try:
         synced = await bot.tree.sync()
@@ -144,6 +1774,7 @@ async def on_ready():
 
 @bot.event
 async def on_guild_join(guild):
+    await data_store.restore_guild(guild.id)
     server_count = len(bot.guilds)
     activity = discord.Game(name=f"{server_count}サーバをプレイ中...")
     await bot.change_presence(status=discord.Status.online, activity=activity)
@@ -151,97 +1782,1044 @@ async def on_guild_join(guild):
 
 @bot.event
 async def on_guild_remove(guild):
+    xp_accumulator.discard_guild(guild.id)
+    await data_store.archive_guild(guild.id)
     server_count = len(bot.guilds)
     activity = discord.Game(name=f"{server_count}サーバをプレイ中...")
     await bot.change_presence(status=discord.Status.online, activity=activity)
     print(f"Left guild: {guild.name} (ID: {guild.id}). Now in {server_count} servers.")
 
-@bot.event
-async def on_message(message):
-    if message.author == bot.user:
-        return
+SPAM_WINDOW = 30  # default seconds a message counts towards a rule
+SPAM_MAX_WINDOW = 300  # longest window a rule may use; idle state is kept this long
+SPAM_DUPLICATE_COUNT = 3  # default identical messages that trigger the duplicate rule
+SPAM_TIMEOUT_MINUTES = 60  # default length of the timeout action
+SPAM_HISTORY_SIZE = 10  # messages remembered per user, and the largest count a rule may use
+SPAM_SWEEP_INTERVAL = 60  # seconds between sweeps of idle anti-spam state
+SPAM_GUILD_MAX_USERS = 5000  # users and bots tracked per guild before the idlest are evicted
+SPAM_MAX_GUILDS = 50000  # guilds with anti-spam state held in memory
+SPAM_GUILD_FINGERPRINTS = 256  # recent fingerprints per guild checked for cross-account spam
+BULK_DELETE_LIMIT = 100  # most messages Discord deletes in one bulk call
+SIMILAR_SHINGLE = 2  # characters per shingle
+SIMILAR_MIN_LENGTH = 10  # shorter messages are only checked for exact repeats
+SIMILAR_MAX_LENGTH = 500  # characters of a message that are fingerprinted
+SIMILAR_SKETCH_SIZE = 32  # smallest shingle hashes kept per message (bottom-k MinHash)
+SIMILAR_THRESHOLD = 80  # default shingle overlap (Jaccard, %) for two messages to count as near-duplicates
+RAID_MESSAGE_WINDOW = 10  # seconds covered by the guild-wide message and mention counters
+RAID_JOIN_WINDOW = 60  # seconds covered by the member join counter
+RAID_BUCKETS = 10  # ring slots per raid counter
+RAID_SLOWMODE_SECONDS = 10  # slowmode applied to channels that see traffic during a raid
+BOT_FLOOD_RECENT = 100  # recent messages remembered per bot or webhook, the bulk delete limit
+BOT_FLOOD_DELETE_DELAY = 1  # seconds flagged messages are gathered before one bulk delete
+
+class IdleTracker:
+    """Per-key state that is dropped once the key has been idle for ttl seconds
+
+    Entries are kept in last-activity order, so touching a key is O(1) and a
+    sweep only visits the entries it evicts. Past max_size the idlest entry
+    is evicted.
+    """
+
+    def __init__(self, ttl, factory=dict, max_size=100000):
+        self.ttl = ttl
+        self.factory = factory
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()  # {key: [last_seen, state]}, idlest first
+
+    def touch(self, key):
+        """State for key, created if missing, marked as active now"""
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [now, self.factory()]
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        else:
+            entry[0] = now
+            self._entries.move_to_end(key)
+        return entry[1]
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        return default if entry is None else entry[1]
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def sweep(self):
+        """Drop entries idle for longer than ttl and return how many were dropped"""
+        cutoff = time.monotonic() - self.ttl
+        evicted = 0
+        while self._entries:
+            last_seen = next(iter(self._entries.values()))[0]
+            if last_seen > cutoff:
+                break
+            self._entries.popitem(last=False)
+            evicted += 1
+        return evicted
 
-    await on_message_for_copy(message)
-    await on_message_for_server_translation(message)
-    await on_message_for_server_logging(message)
+    def values(self):
+        return [entry[1] for entry in self._entries.values()]
 
-    if message.content.startswith('!'):
-        await bot.process_commands(message)
-        return
+    def items(self):
+        return [(key, entry[1]) for key, entry in self._entries.items()]
 
-    user_id = message.author.id
-    current_time = time.time()
+    def __len__(self):
+        return len(self._entries)
 
-    # Bot message auto-deletion disabled
-    if message.author.bot:
-        # Skip bot message processing
-        pass
+    def __contains__(self, key):
+        return key in self._entries
 
-    if not message.author.bot:
-        if user_id not in user_message_history:
-            user_message_history[user_id] = []
+class SlidingCounter:
+    """Events over the last window seconds, kept in a fixed ring of time buckets
 
-        user_message_history[user_id].append({
-            'content': message.content,
-            'timestamp': current_time
-        })
+    Adding an event is O(1); buckets that fall out of the window are cleared
+    as time advances, at most once each per trip around the ring.
+    """
+    __slots__ = ('resolution', 'counts', 'head', 'total')
 
-        user_message_history[user_id] = [
-            msg for msg in user_message_history[user_id]
-            if current_time - msg['timestamp'] <= 30
-        ]
+    def __init__(self, window, buckets=RAID_BUCKETS):
+        self.resolution = window / buckets
+        self.counts = array('q', bytes(8 * buckets))
+        self.head = 0  # absolute number of the newest bucket
+        self.total = 0
 
-        if len(user_message_history[user_id]) >= 3:
-            recent_messages = user_message_history[user_id][-3:]
-            
-            if (len(set(msg['content'] for msg in recent_messages)) == 1 and 
-                recent_messages[0]['content'].strip() != ""):
-                
-                try:
-                    print(f"Identical message spam detected from {message.author.name} (ID: {user_id})")
-                    print(f"Repeated message: {message.content[:50]}...")
-
-                    messages_to_delete = []
-                    async for msg in message.channel.history(limit=10):
-                        if (msg.author.id == user_id and 
-                            msg.content == message.content and
-                            current_time - msg.created_at.timestamp() <= 30):
-                            messages_to_delete.append(msg)
-                            if len(messages_to_delete) >= 3:
-                                break
-                    
-                    for msg in messages_to_delete[:3]:
-                        try:
-                            await msg.delete()
-                        except:
-                            pass
+    def _advance(self, now):
+        bucket = int(now // self.resolution)
+        steps = bucket - self.head
+        if steps <= 0:
+            return
+        size = len(self.counts)
+        if steps >= size:
+            self.counts = array('q', bytes(8 * size))
+            self.total = 0
+        else:
+            for stale in range(self.head + 1, bucket + 1):
+                index = stale % size
+                self.total -= self.counts[index]
+                self.counts[index] = 0
+        self.head = bucket
+
+    def add(self, now, amount=1):
+        self._advance(now)
+        self.counts[self.head % len(self.counts)] += amount
+        self.total += amount
+        return self.total
+
+    def value(self, now):
+        self._advance(now)
+        return self.total
+
+@dataclass(slots=True)
+class RaidState:
+    """Guild-wide raid counters and the raid mode of one guild"""
+    messages: SlidingCounter = field(default_factory=lambda: SlidingCounter(RAID_MESSAGE_WINDOW))
+    new_member_messages: SlidingCounter = field(default_factory=lambda: SlidingCounter(RAID_MESSAGE_WINDOW))
+    mentions: SlidingCounter = field(default_factory=lambda: SlidingCounter(RAID_MESSAGE_WINDOW))
+    joins: SlidingCounter = field(default_factory=lambda: SlidingCounter(RAID_JOIN_WINDOW))
+    until: float = 0.0  # time.monotonic() at which raid mode ends, 0 when inactive
+    slowed_channels: dict = field(default_factory=dict)  # {channel_id: slowmode delay before the raid}
+
+    def active(self, now):
+        return self.until > now
+
+@dataclass(slots=True)
+class TokenBucket:
+    """Message budget of one bot or webhook in a guild, with its recent messages"""
+    tokens: float | None = None  # None until the first message, then refilled lazily
+    updated: float = 0.0
+    flagged: bool = False  # flooding was detected; messages are deleted on sight until the budget refills
+    recent: collections.deque = field(default_factory=lambda: collections.deque(maxlen=BOT_FLOOD_RECENT))
+    pending_delete: list = field(default_factory=list)  # entries waiting for the next bulk delete
+
+    def refill(self, now, rate, burst):
+        """Add the tokens earned since the last message; True when the budget is full again"""
+        if self.tokens is None:
+            self.tokens = float(burst)
+        else:
+            self.tokens = min(float(burst), self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens >= burst
+
+    def take(self, now, rate, burst):
+        """Spend a token for a message; False when the budget is exhausted"""
+        self.refill(now, rate, burst)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+def new_message_history():
+    return collections.deque(maxlen=SPAM_HISTORY_SIZE)
+
+def new_guild_fingerprints():
+    return collections.deque(maxlen=SPAM_GUILD_FINGERPRINTS)
+
+@dataclass(slots=True)
+class GuildSpamState:
+    """Anti-spam state of one guild, bounded independently of every other guild"""
+    # History entries are (timestamp, content hash, channel_id, message_id, sketch or None, user_id)
+    # user_id -> deque of entries, newest last
+    user_message_history: IdleTracker = field(
+        default_factory=lambda: IdleTracker(SPAM_MAX_WINDOW, new_message_history, max_size=SPAM_GUILD_MAX_USERS))
+    bot_buckets: IdleTracker = field(  # bot or webhook id -> TokenBucket
+        default_factory=lambda: IdleTracker(SPAM_MAX_WINDOW, TokenBucket, max_size=SPAM_GUILD_MAX_USERS))
+    fingerprints: collections.deque = field(default_factory=new_guild_fingerprints)  # fingerprinted entries, all users
+    raid: RaidState = field(default_factory=RaidState)
+
+    def forget(self, entries):
+        """Drop entries that were already acted on from the guild-wide fingerprint index"""
+        if not self.fingerprints:
+            return
+        message_ids = {entry[3] for entry in entries}
+        kept = [entry for entry in self.fingerprints if entry[3] not in message_ids]
+        self.fingerprints.clear()
+        self.fingerprints.extend(kept)
+
+    def sweep(self):
+        return self.user_message_history.sweep() + self.bot_buckets.sweep()
 
-                    print(f"Deleted {min(len(messages_to_delete), 3)} consecutive identical messages")
+# guild_id -> GuildSpamState; a guild goes idle no earlier than its busiest user
+guild_spam_states = IdleTracker(SPAM_MAX_WINDOW, GuildSpamState, max_size=SPAM_MAX_GUILDS)
+spam_sweeper_task = None
 
-                    from datetime import timedelta
-                    timeout_duration = discord.utils.utcnow() + timedelta(hours=1)
-                    await message.author.timeout(timeout_duration, reason="同じメッセージの連投によるスパム")
+async def sweep_spam_trackers():
+    """Periodically drop the anti-spam state of users and bots that went quiet"""
+    while True:
+        await asyncio.sleep(SPAM_SWEEP_INTERVAL)
+        try:
+            now = time.monotonic()
+            for guild_id, state in guild_spam_states.items():
+                if state.raid.until:
+                    if state.raid.active(now):
+                        guild_spam_states.touch(guild_id)  # Keep a guild in raid mode from being swept
+                    else:
+                        await end_raid_mode(bot.get_guild(guild_id), state.raid)
+            evicted = guild_spam_states.sweep()
+            evicted += sum(state.sweep() for state in guild_spam_states.values())
+            if evicted:
+                print(f"Swept {evicted} idle anti-spam entries")
+        except Exception as e:
+            print(f"Error sweeping anti-spam state: {e}")
+
+def start_spam_sweeper():
+    global spam_sweeper_task
+    if spam_sweeper_task is None:
+        spam_sweeper_task = asyncio.create_task(sweep_spam_trackers())
+
+async def delete_tracked_messages(guild, entries):
+    """Bulk delete tracked history entries per channel, 100 at a time, returning how many were removed"""
+    by_channel = collections.defaultdict(list)
+    for entry in entries:
+        by_channel[entry[2]].append(discord.Object(id=entry[3]))
+
+    async def delete_in(channel_id, messages):
+        channel = guild.get_channel_or_thread(channel_id)
+        if channel is None:
+            return 0
+        deleted = 0
+        for start in range(0, len(messages), BULK_DELETE_LIMIT):
+            batch = messages[start:start + BULK_DELETE_LIMIT]
+            try:
+                await channel.delete_messages(batch)
+            except (discord.HTTPException, discord.ClientException) as e:
+                print(f"Failed to bulk delete spam in {channel_id}: {e}")
+                continue
+            deleted += len(batch)
+        return deleted
+
+    counts = await asyncio.gather(*(delete_in(channel_id, messages) for channel_id, messages in by_channel.items()))
+    return sum(counts)
+
+SPAM_ACTIONS = {'delete': '削除', 'timeout': 'タイムアウト', 'kick': 'キック', 'ban': 'BAN'}
+SPAM_RULE_LABELS = {'blocklist': '禁止ワード・リンクの投稿', 'duplicate': '同じメッセージの連投',
+                    'similar': '似たメッセージの連投', 'raid_similar': '複数アカウントによる類似メッセージ',
+                    'flood': '短時間での大量投稿'}
+DEFAULT_SPAM_RULES = {
+    'blocklist': {'enabled': True, 'action': 'delete', 'words': [], 'domains': [], 'invites': [], 'all_invites': False},
+    'duplicate': {'enabled': True, 'count': SPAM_DUPLICATE_COUNT, 'window': SPAM_WINDOW, 'action': 'timeout'},
+    # Opt-in: ordinary conversation repeats itself ("I think that's a good/bad idea")
+    'similar': {'enabled': False, 'count': SPAM_DUPLICATE_COUNT, 'window': SPAM_WINDOW, 'action': 'delete',
+                'similarity': SIMILAR_THRESHOLD},
+    'raid_similar': {'enabled': False, 'count': 3, 'window': 60, 'action': 'timeout',
+                     'similarity': SIMILAR_THRESHOLD},
+    'flood': {'enabled': False, 'count': SPAM_HISTORY_SIZE, 'window': 10, 'action': 'delete'}
+}
 
-                    print(f"Successfully timed out {message.author.name}")
+RAID_METRICS = {'messages': f'メッセージ数/{RAID_MESSAGE_WINDOW}秒',
+                'new_member_messages': f'新規メンバーのメッセージ数/{RAID_MESSAGE_WINDOW}秒',
+                'mentions': f'メンション数/{RAID_MESSAGE_WINDOW}秒',
+                'joins': f'参加者数/{RAID_JOIN_WINDOW}秒'}
+RAID_RESPONSES = {'alert': 'アラートを送信', 'slowmode': '低速モード',
+                  'timeout_new': '新規メンバーの投稿を削除してタイムアウト', 'kick_joins': '参加者をキック'}
+DEFAULT_RAID_SETTINGS = {
+    'enabled': False,
+    'thresholds': {'messages': 60, 'new_member_messages': 20, 'mentions': 40, 'joins': 10},  # 0 turns a trigger off
+    'new_member_minutes': 10,
+    'duration_minutes': 10,
+    'responses': ['alert', 'slowmode', 'timeout_new']
+}
 
-                    warning_embed = discord.Embed(
-                        title="🚫 タイムアウト適用",
-                        description=f"{message.author.mention} は同じメッセージの連投により1時間のタイムアウトが適用されました。",
-                        color=0xff0000
-                    )
-                    sent_warning = await message.channel.send(embed=warning_embed, delete_after=15)
+def normalize_raid_settings(settings):
+    """Fill defaults and validate a guild's raid detection settings"""
+    settings = {**DEFAULT_RAID_SETTINGS, **settings}
+    thresholds = {**DEFAULT_RAID_SETTINGS['thresholds'], **settings['thresholds']}
+    responses = set(settings['responses'])
+    if not responses <= RAID_RESPONSES.keys():
+        raise ValueError(f"Unknown raid responses: {responses - RAID_RESPONSES.keys()}")
+    return {
+        'enabled': bool(settings['enabled']),
+        'thresholds': {metric: max(0, int(thresholds[metric])) for metric in RAID_METRICS},
+        'new_member_minutes': max(0, int(settings['new_member_minutes'])),
+        'duration_minutes': min(max(1, int(settings['duration_minutes'])), 1440),
+        'responses': [response for response in RAID_RESPONSES if response in responses]
+    }
+
+BOT_FLOOD_ACTIONS = {'delete': '削除', 'kick': 'キック', 'ban': 'BAN'}  # webhooks are deleted for kick and ban
+DEFAULT_BOT_FLOOD_SETTINGS = {'enabled': False, 'burst': 10, 'rate': 1.0, 'action': 'ban'}
+
+def normalize_bot_flood_settings(settings):
+    """Fill defaults and validate a guild's bot and webhook flood settings"""
+    settings = {**DEFAULT_BOT_FLOOD_SETTINGS, **settings}
+    if settings['action'] not in BOT_FLOOD_ACTIONS:
+        raise ValueError(f"Unknown bot flood action: {settings['action']}")
+    return {
+        'enabled': bool(settings['enabled']),
+        'burst': min(max(int(settings['burst']), 1), BOT_FLOOD_RECENT),
+        'rate': min(max(float(settings['rate']), 0.01), 100.0),
+        'action': settings['action']
+    }
+
+BLOCKLIST_MAX_PATTERNS = 1000  # entries per blocklist
+INVITE_PREFIXES = ('discord.gg/', 'discord.com/invite/', 'discordapp.com/invite/')
+
+def normalize_domain(domain):
+    domain = domain.strip().lower()
+    for prefix in ('https://', 'http://', 'www.'):
+        domain = domain.removeprefix(prefix)
+    return domain.split('/', 1)[0]
+
+def normalize_invite(invite):
+    """Invite code of a code or invite link"""
+    return invite.strip().rstrip('/').rsplit('/', 1)[-1].casefold()
+
+def normalize_blocklists(rule):
+    lists = {
+        'words': sorted({word.strip().casefold() for word in rule['words']} - {''}),
+        'domains': sorted({normalize_domain(domain) for domain in rule['domains']} - {''}),
+        'invites': sorted({normalize_invite(invite) for invite in rule['invites']} - {''}),
+        'all_invites': bool(rule['all_invites'])
+    }
+    if any(len(lists[kind]) > BLOCKLIST_MAX_PATTERNS for kind in ('words', 'domains', 'invites')):
+        raise ValueError(f"Blocklists are limited to {BLOCKLIST_MAX_PATTERNS} entries")
+    return lists
+
+def normalize_antispam_rules(config):
+    """Fill defaults and validate a guild's anti-spam rules"""
+    rules = {}
+    for name, defaults in DEFAULT_SPAM_RULES.items():
+        rule = {**defaults, **config.get('rules', {}).get(name, {})}
+        if rule['action'] not in SPAM_ACTIONS:
+            raise ValueError(f"Unknown anti-spam action: {rule['action']}")
+        rules[name] = {'enabled': bool(rule['enabled']), 'action': rule['action']}
+        if 'count' in defaults:
+            rules[name]['count'] = min(max(int(rule['count']), 2), SPAM_HISTORY_SIZE)
+            rules[name]['window'] = min(max(float(rule['window']), 1.0), float(SPAM_MAX_WINDOW))
+        if 'words' in defaults:
+            rules[name].update(normalize_blocklists(rule))
+        if 'similarity' in defaults:
+            rules[name]['similarity'] = min(max(int(rule['similarity']), 1), 100)
+    return {
+        'rules': rules,
+        'timeout_minutes': max(1, int(config.get('timeout_minutes', SPAM_TIMEOUT_MINUTES))),
+        'exempt_channels': sorted({int(channel_id) for channel_id in config.get('exempt_channels', [])}),
+        'exempt_roles': sorted({int(role_id) for role_id in config.get('exempt_roles', [])}),
+        'shadow': bool(config.get('shadow', False)),
+        'raid': normalize_raid_settings(config.get('raid', {})),
+        'bot_flood': normalize_bot_flood_settings(config.get('bot_flood', {}))
+    }
+
+antispam_rules = config_registry.register('antispam_rules', 'antispam_rules.json',
+                                          normalize_antispam_rules)  # {guild_id: rules}
+
+def text_sketch(text):
+    """Bottom-k MinHash sketch of text's character shingles, or None when the text is too short
+
+    Case and whitespace are ignored. The sketch is the SIMILAR_SKETCH_SIZE
+    smallest shingle hashes, so messages up to that many shingles keep their
+    whole shingle set and compare exactly.
+    """
+    text = ''.join(text.lower().split())[:SIMILAR_MAX_LENGTH]
+    if len(text) < SIMILAR_MIN_LENGTH:
+        return None
+    shingles = {hash(text[index:index + SIMILAR_SHINGLE]) for index in range(len(text) - SIMILAR_SHINGLE + 1)}
+    if len(shingles) > SIMILAR_SKETCH_SIZE:
+        shingles = heapq.nsmallest(SIMILAR_SKETCH_SIZE, shingles)
+    return frozenset(shingles)
+
+def sketch_similarity(a, b):
+    """Estimated Jaccard similarity (%) of the shingle sets behind two sketches
+
+    The smallest hashes of the union are a uniform sample of it; the share of
+    them present in both sketches estimates the share of shingles in common.
+    """
+    union = sorted(a | b)[:SIMILAR_SKETCH_SIZE]
+    return 100 * len((a & b).intersection(union)) // len(union)
+
+class PhraseMatcher:
+    """Aho-Corasick automaton that finds any of a set of phrases in one pass over a text
+
+    Domain and invite phrases only match on URL boundaries, so blocking
+    example.com leaves notexample.com alone. Words match on word boundaries
+    where they start or end with an ASCII letter or digit (blocking "his"
+    leaves "this" alone); other scripts, such as CJK, have no spaces between
+    words, so those ends match anywhere.
+    """
+    __slots__ = ('transitions', 'fail', 'outputs')
+
+    def __init__(self, phrases):
+        """phrases: iterable of (phrase, kind) with kind 'word', 'domain' or 'invite'"""
+        self.transitions = [{}]
+        self.outputs = [()]
+        for phrase, kind in phrases:
+            state = 0
+            for char in phrase:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][char] = next_state
+                    self.transitions.append({})
+                    self.outputs.append(())
+                state = next_state
+            self.outputs[state] += ((phrase, kind),)
+
+        self.fail = [0] * len(self.transitions)
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.transitions[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.outputs[next_state] += self.outputs[self.fail[next_state]]
+                queue.append(next_state)
+
+    @staticmethod
+    def _url_char(text, index):
+        return 0 <= index < len(text) and (text[index].isalnum() or text[index] in '-_')
+
+    @staticmethod
+    def _ascii_word_char(text, index):
+        return 0 <= index < len(text) and text[index].isascii() and (text[index].isalnum() or text[index] == '_')
+
+    def search(self, text):
+        """(phrase, kind) of the first phrase found in text, or None"""
+        transitions, fail, outputs = self.transitions, self.fail, self.outputs
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            for phrase, kind in outputs[state]:
+                end = index + 1
+                if kind == 'word':
+                    start = end - len(phrase)
+                    if ((self._ascii_word_char(phrase, 0) and self._ascii_word_char(text, start - 1))
+                            or (self._ascii_word_char(phrase, len(phrase) - 1) and self._ascii_word_char(text, end))):
+                        continue
+                    return phrase, kind
+                if self._url_char(text, end) or (text[end:end + 1] == '.' and self._url_char(text, end + 1)):
+                    continue
+                if kind == 'domain' and self._url_char(text, end - len(phrase) - 1):
+                    continue
+                return phrase, kind
+        return None
+
+def compile_blocklists(rule):
+    """PhraseMatcher for a blocklist rule, or None when it blocks nothing"""
+    phrases = [(word, 'word') for word in rule['words']]
+    phrases += [(domain, 'domain') for domain in rule['domains']]
+    phrases += [(prefix + code, 'invite') for code in rule['invites'] for prefix in INVITE_PREFIXES]
+    if rule['all_invites']:
+        phrases += [(prefix, 'word') for prefix in INVITE_PREFIXES]
+    return PhraseMatcher(phrases) if phrases else None
+
+def blocklist_check(rule):
+    """Matches the newest message when it contains a blocked word, domain or invite"""
+    matcher = compile_blocklists(rule)
+    if matcher is None:
+        return None
+    def check(message, history, guild_state, now):
+        if not message.content:
+            return None
+        found = matcher.search(message.content.casefold())
+        if found is None:
+            return None
+        print(f"Blocked {found[1]} '{found[0]}' in message {message.id}")
+        return [history[-1]]
+    return check
+
+def duplicate_check(rule):
+    """Matches when the newest message's text was sent count times within the window"""
+    count, window = rule['count'], rule['window']
+    def check(message, history, guild_state, now):
+        if not message.content.strip():
+            return None
+        content_hash = history[-1][1]
+        matched = [entry for entry in history if entry[1] == content_hash and now - entry[0] <= window]
+        return matched if len(matched) >= count else None
+    return check
+
+def similar_check(rule):
+    """Matches when count of the user's recent messages are near-duplicates of the newest one"""
+    count, window, similarity = rule['count'], rule['window'], rule['similarity']
+    def check(message, history, guild_state, now):
+        fingerprint = history[-1][4]
+        if fingerprint is None:
+            return None
+        matched = [entry for entry in history if entry[4] is not None and now - entry[0] <= window
+                   and sketch_similarity(entry[4], fingerprint) >= similarity]
+        return matched if len(matched) >= count else None
+    return check
+
+def raid_similar_check(rule):
+    """Matches when count different users posted near-duplicates of the newest message"""
+    count, window, similarity = rule['count'], rule['window'], rule['similarity']
+    def check(message, history, guild_state, now):
+        fingerprint = history[-1][4]
+        if fingerprint is None:
+            return None
+        matched = [entry for entry in guild_state.fingerprints if now - entry[0] <= window
+                   and sketch_similarity(entry[4], fingerprint) >= similarity]
+        return matched if len({entry[5] for entry in matched}) >= count else None
+    return check
+
+def flood_check(rule):
+    """Matches when count messages of any kind were sent within the window"""
+    count, window = rule['count'], rule['window']
+    def check(message, history, guild_state, now):
+        matched = [entry for entry in history if now - entry[0] <= window]
+        return matched if len(matched) >= count else None
+    return check
+
+SPAM_CHECKS = {'blocklist': blocklist_check, 'duplicate': duplicate_check, 'similar': similar_check, 'raid_similar': raid_similar_check,
+               'flood': flood_check}
+
+@dataclass(slots=True)
+class CompiledRaidSettings:
+    """A guild's raid settings as plain attributes for the on_message hot path"""
+    messages: int
+    new_member_messages: int
+    mentions: int
+    joins: int
+    new_member_age: float  # seconds since joining during which a member counts as new
+    duration: float  # seconds raid mode lasts after the last trigger
+    responses: frozenset
+
+    @classmethod
+    def compile(cls, settings):
+        if not settings['enabled']:
+            return None
+        thresholds = settings['thresholds']
+        return cls(thresholds['messages'], thresholds['new_member_messages'], thresholds['mentions'],
+                   thresholds['joins'], settings['new_member_minutes'] * 60, settings['duration_minutes'] * 60,
+                   frozenset(settings['responses']))
+
+    def is_new_member(self, member):
+        joined_at = getattr(member, 'joined_at', None)
+        return (joined_at is not None
+                and (discord.utils.utcnow() - joined_at).total_seconds() < self.new_member_age)
+
+@dataclass(slots=True)
+class CompiledBotFloodSettings:
+    burst: int  # messages a bot or webhook may send back to back
+    rate: float  # messages per second it may keep sending after that
+    action: str
+    window: float  # seconds a full budget takes to refill; older messages are left alone
+
+    @classmethod
+    def compile(cls, settings):
+        if not settings['enabled']:
+            return None
+        return cls(settings['burst'], settings['rate'], settings['action'], settings['burst'] / settings['rate'])
+
+@dataclass(slots=True)
+class CompiledSpamRules:
+    """A guild's anti-spam rules as a precomputed check list for the on_message hot path"""
+    checks: tuple  # ((rule name, check, action), ...) for the enabled rules that can match, in order
+    window: float  # longest window of any enabled rule
+    fingerprint: bool  # whether any enabled rule needs message fingerprints
+    guild_fingerprints: bool  # whether fingerprints go into the guild-wide index
+    timeout_minutes: int
+    exempt_channels: frozenset
+    exempt_roles: frozenset
+    shadow: bool
+    raid: CompiledRaidSettings | None  # None when raid detection is off
+    bot_flood: CompiledBotFloodSettings | None  # None when bot flood detection is off
+    blocklist: object  # the blocklist check, also run on bot and webhook messages; None when off
+
+    @classmethod
+    def compile(cls, config):
+        enabled = [(name, rule) for name, rule in config['rules'].items() if rule['enabled']]
+        checks = ((name, SPAM_CHECKS[name](rule), rule['action']) for name, rule in enabled)
+        checks = tuple(check for check in checks if check[1] is not None)
+        return cls(checks,
+                   max((rule.get('window', 0.0) for _, rule in enabled), default=0.0),
+                   any('similarity' in rule for _, rule in enabled),
+                   any(name == 'raid_similar' for name, _ in enabled),
+                   config['timeout_minutes'],
+                   frozenset(config['exempt_channels']), frozenset(config['exempt_roles']),
+                   config['shadow'], CompiledRaidSettings.compile(config['raid']),
+                   CompiledBotFloodSettings.compile(config['bot_flood']),
+                   next((check for name, check, _ in checks if name == 'blocklist'), None))
+
+    def exempt(self, message):
+        channel = message.channel
+        if channel.id in self.exempt_channels or getattr(channel, 'parent_id', None) in self.exempt_channels:
+            return True
+        return (bool(self.exempt_roles) and isinstance(message.author, discord.Member)
+                and any(message.author.get_role(role_id) for role_id in self.exempt_roles))
+
+    def evaluate(self, message, history, guild_state, now):
+        """(rule name, action, matched history entries) of the first rule the message trips, or None"""
+        for name, check, action in self.checks:
+            matched = check(message, history, guild_state, now)
+            if matched:
+                return name, action, matched
+        return None
+
+DEFAULT_ANTISPAM_RULES = CompiledSpamRules.compile(normalize_antispam_rules({}))
+compiled_antispam_rules = {}  # {guild_id: CompiledSpamRules}, compiled on first use
+spam_rule_hits = {}  # {guild_id: Counter of rule name -> times it matched}
+
+def get_antispam_rules(guild_id):
+    rules = compiled_antispam_rules.get(guild_id)
+    if rules is None:
+        config = antispam_rules.get(str(guild_id))
+        rules = DEFAULT_ANTISPAM_RULES if config is None else CompiledSpamRules.compile(config)
+        compiled_antispam_rules[guild_id] = rules
+    return rules
+
+def on_antispam_rules_changed(guild_id, config):
+    """Recompile on the next message after a guild's rules change"""
+    compiled_antispam_rules.pop(int(guild_id), None)
+
+antispam_rules.subscribe(on_antispam_rules_changed)
+
+async def apply_spam_action(message, rule_name, action, entries, rules):
+    """Delete the messages a rule matched, then carry out its action against everyone who sent them"""
+    from datetime import timedelta
+    guild = message.guild
+    label = SPAM_RULE_LABELS[rule_name]
+    reason = f"{label}によるスパム"
+    offenders = [message.author]
+    offenders += [member for member in map(guild.get_member, {entry[5] for entry in entries} - {message.author.id})
+                  if member is not None]
+    try:
+        print(f"Anti-spam rule {rule_name} matched {', '.join(member.name for member in offenders)}, action: {action}")
+        deleted = await delete_tracked_messages(guild, entries)
+        print(f"Deleted {deleted} spam messages")
+
+        for member in offenders:
+            try:
+                if action == 'timeout':
+                    await member.timeout(timedelta(minutes=rules.timeout_minutes), reason=reason)
+                elif action == 'kick':
+                    await member.kick(reason=reason)
+                elif action == 'ban':
+                    await member.ban(reason=reason, delete_message_seconds=0)
+            except discord.Forbidden as e:
+                print(f"Failed to moderate {member.name} - insufficient permissions: {e}")
+        print(f"Applied anti-spam action {action} to {len(offenders)} member(s)")
+
+        mentions = ' '.join(member.mention for member in offenders)
+        if action == 'timeout':
+            description = f"{mentions} は{label}により{rules.timeout_minutes}分間のタイムアウトが適用されました。"
+        elif action == 'kick':
+            description = f"{mentions} は{label}によりキックされました。"
+        elif action == 'ban':
+            description = f"{mentions} は{label}によりBANされました。"
+        else:
+            description = f"{mentions} の{label}を削除しました。"
+
+        warning_embed = discord.Embed(
+            title=f"🚫 {SPAM_ACTIONS[action]}適用",
+            description=description,
+            color=0xff0000
+        )
+        await message.channel.send(embed=warning_embed, delete_after=15)
+    except discord.Forbidden as e:
+        print(f"Failed to moderate {message.author.name} - insufficient permissions: {e}")
+    except Exception as e:
+        print(f"Error in anti-spam: {e}")
+
+async def track_bot_message(message, rules):
+    """Charge a bot or webhook message to its token bucket and act once it floods"""
+    settings = rules.bot_flood
+    guild = message.guild
+    author_id = message.webhook_id or message.author.id
+    bucket = guild_spam_states.touch(guild.id).bot_buckets.touch(author_id)
+    now = time.monotonic()
+    entry = (now, None, message.channel.id, message.id)
+
+    if bucket.flagged and bucket.refill(now, settings.rate, settings.burst):
+        bucket.flagged = False  # Quiet for long enough to earn a full budget: the flood is over
+    if bucket.flagged:
+        # Already handled: keep charging the bucket, so the flag holds while the flood goes on,
+        # and gather the rest of the flood into one delayed bulk delete
+        bucket.take(now, settings.rate, settings.burst)
+        bucket.pending_delete.append(entry)
+        if len(bucket.pending_delete) == 1:
+            asyncio.create_task(delete_pending_bot_messages(guild, bucket))
+        return
+    bucket.recent.append(entry)
+    if bucket.take(now, settings.rate, settings.burst):
+        return
+
+    spam_rule_hits.setdefault(guild.id, collections.Counter())['bot_flood'] += 1
+    if rules.shadow:
+        print(f"[shadow] Bot flood from {message.author.name} (ID: {author_id}) in {guild.name}")
+        return
+    bucket.flagged = True
+    entries = [recent for recent in bucket.recent if now - recent[0] <= settings.window]
+    bucket.recent.clear()
+    await apply_bot_flood_action(message, settings, entries)
+
+async def delete_pending_bot_messages(guild, bucket):
+    await asyncio.sleep(BOT_FLOOD_DELETE_DELAY)
+    pending, bucket.pending_delete = bucket.pending_delete, []
+    await delete_tracked_messages(guild, pending)
+
+async def apply_bot_flood_action(message, settings, entries):
+    """Bulk delete a flooding bot's messages, then kick or ban it (webhooks are deleted instead)"""
+    author = message.author
+    kind = 'Webhook' if message.webhook_id else 'Bot'
+    try:
+        print(f"{kind} flood detected from {author.name} (ID: {author.id}), action: {settings.action}")
+        deleted = await delete_tracked_messages(message.guild, entries)
+        print(f"Deleted {deleted} flood messages")
+
+        if settings.action != 'delete':
+            reason = f"{kind}による大量投稿"
+            if message.webhook_id:
+                webhook = await bot.fetch_webhook(message.webhook_id)
+                await webhook.delete(reason=reason)
+            elif settings.action == 'kick':
+                await message.guild.kick(author, reason=reason)
+            else:
+                await message.guild.ban(author, reason=reason, delete_message_seconds=0)
+            print(f"Applied bot flood action {settings.action} to {author.name}")
+
+        warning_embed = discord.Embed(
+            title=f"🚫 {kind}の大量投稿を検知",
+            description=(f"{author.mention} のメッセージ{deleted}件を削除しました。"
+                         + ('' if settings.action == 'delete' else
+                            'Webhookを削除しました。' if message.webhook_id else
+                            f"{BOT_FLOOD_ACTIONS[settings.action]}しました。")),
+            color=0xff0000
+        )
+        await message.channel.send(embed=warning_embed, delete_after=15)
+    except discord.Forbidden as e:
+        print(f"Failed to stop {kind.lower()} flood from {author.name} - insufficient permissions: {e}")
+    except Exception as e:
+        print(f"Error in bot flood protection: {e}")
 
-                    user_message_history[user_id] = []
+async def start_raid_mode(guild, raid_state, raid, metric, channel):
+    """Enter or extend raid mode; alert and slow the channel when it starts"""
+    already_active = raid_state.active(time.monotonic())
+    raid_state.until = time.monotonic() + raid.duration
+    if already_active:
+        return
+    print(f"Raid detected in {guild.name} (ID: {guild.id}) by {metric}; raid mode for {raid.duration:g}s")
+    if channel is None:
+        return
+    if 'slowmode' in raid.responses:
+        await slow_raid_channel(raid_state, channel)
+    if 'alert' in raid.responses:
+        embed = discord.Embed(
+            title="🚨 レイドを検知しました",
+            description=(f"{RAID_METRICS[metric]}がしきい値を超えたため、"
+                         f"{raid.duration / 60:g}分間レイドモードを有効にしました。"),
+            color=0xff0000
+        )
+        embed.add_field(name="対応", value='\n'.join(f"• {RAID_RESPONSES[response]}"
+                                                    for response in RAID_RESPONSES if response in raid.responses))
+        try:
+            await channel.send(embed=embed)
+        except discord.HTTPException as e:
+            print(f"Failed to send raid alert in {channel.id}: {e}")
 
-                except discord.Forbidden as e:
-                    print(f"Failed to moderate {message.author.name} - insufficient permissions: {e}")
-                except Exception as e:
-                    print(f"Error in anti-spam: {e}")
+async def slow_raid_channel(raid_state, channel):
+    if channel.id in raid_state.slowed_channels or not isinstance(channel, discord.TextChannel):
+        return
+    raid_state.slowed_channels[channel.id] = channel.slowmode_delay
+    if channel.slowmode_delay >= RAID_SLOWMODE_SECONDS:
+        return
+    try:
+        await channel.edit(slowmode_delay=RAID_SLOWMODE_SECONDS, reason="レイドモード")
+    except discord.HTTPException as e:
+        print(f"Failed to enable raid slowmode in {channel.id}: {e}")
+
+async def end_raid_mode(guild, raid_state):
+    """Leave raid mode and restore the slowmode of channels it changed"""
+    slowed_channels, raid_state.slowed_channels = raid_state.slowed_channels, {}
+    raid_state.until = 0.0
+    if guild is None:
+        return
+    print(f"Raid mode ended in {guild.name} (ID: {guild.id})")
+    for channel_id, delay in slowed_channels.items():
+        channel = guild.get_channel(channel_id)
+        if channel is None or delay >= RAID_SLOWMODE_SECONDS:
+            continue
+        try:
+            await channel.edit(slowmode_delay=delay, reason="レイドモード解除")
+        except discord.HTTPException as e:
+            print(f"Failed to restore slowmode in {channel_id}: {e}")
+
+async def track_raid_message(message, rules):
+    """Count a message towards the guild's raid counters; True when raid mode removed it"""
+    raid = rules.raid
+    raid_state = guild_spam_states.touch(message.guild.id).raid
+    now = time.monotonic()
+    if raid_state.until and not raid_state.active(now):
+        await end_raid_mode(message.guild, raid_state)
+
+    new_member = raid.is_new_member(message.author)
+    mentions = len(message.mentions) + len(message.role_mentions) + message.mention_everyone
+    triggered = None
+    if raid_state.messages.add(now) >= raid.messages > 0:
+        triggered = 'messages'
+    if new_member and raid_state.new_member_messages.add(now) >= raid.new_member_messages > 0:
+        triggered = 'new_member_messages'
+    if mentions and raid_state.mentions.add(now, mentions) >= raid.mentions > 0:
+        triggered = 'mentions'
+
+    if triggered is not None:
+        spam_rule_hits.setdefault(message.guild.id, collections.Counter())['raid'] += 1
+        if rules.shadow:
+            print(f"[shadow] Raid threshold {triggered} crossed in {message.guild.name} (ID: {message.guild.id})")
+            return False
+        await start_raid_mode(message.guild, raid_state, raid, triggered, message.channel)
+
+    if not raid_state.active(now):
+        return False
+    if 'slowmode' in raid.responses:
+        await slow_raid_channel(raid_state, message.channel)
+    if new_member and 'timeout_new' in raid.responses:
+        from datetime import timedelta
+        try:
+            await message.delete()
+            await message.author.timeout(timedelta(minutes=rules.timeout_minutes), reason="レイドモード中の新規メンバーの投稿")
+        except discord.HTTPException as e:
+            print(f"Failed to moderate {message.author.name} during raid mode: {e}")
+        return True
+    return False
 
-    if not message.author.bot and not message.content.startswith('/'):
-        add_experience(message.author.id, message.guild.id, 5)
+@bot.event
+async def on_member_join(member):
+    if member.bot:
+        return
+    rules = get_antispam_rules(member.guild.id)
+    raid = rules.raid
+    if raid is None:
+        return
+    raid_state = guild_spam_states.touch(member.guild.id).raid
+    now = time.monotonic()
+    if raid_state.joins.add(now) >= raid.joins > 0:
+        spam_rule_hits.setdefault(member.guild.id, collections.Counter())['raid'] += 1
+        if rules.shadow:
+            print(f"[shadow] Raid threshold joins crossed in {member.guild.name} (ID: {member.guild.id})")
+            return
+        await start_raid_mode(member.guild, raid_state, raid, 'joins', member.guild.system_channel)
+    if raid_state.active(now) and 'kick_joins' in raid.responses:
+        try:
+            await member.kick(reason="レイドモード中の参加")
+            print(f"Kicked {member.name} who joined {member.guild.name} during raid mode")
+        except discord.HTTPException as e:
+            print(f"Failed to kick {member.name} during raid mode: {e}")
+
+ALL_CHANNELS = object()  # channel filter of a feature that is on in every channel of a guild
+
+@dataclass(slots=True, eq=False)
+class MessageFeature:
+    """An on_message handler and where each guild has it switched on"""
+    name: str
+    handler: object  # async handler(message), returning True when it removed the message
+    channels: object  # channels(guild_id): None when off, ALL_CHANNELS, or the channel ids it is on in
+    stage: int  # later stages are skipped once a handler removes the message
+    humans: bool
+    bots: bool
+    commands: bool  # also sees '!' prefix command messages
+
+message_features = []
+
+def register_message_feature(name, handler, channels, stage=0, humans=True, bots=False, commands=False):
+    """Route guild messages to handler wherever channels(guild_id) says the feature is on"""
+    message_features.append(MessageFeature(name, handler, channels, stage, humans, bots, commands))
+    guild_message_routes.clear()
+
+class MessageRoutes:
+    """Handlers one guild runs for a message, indexed by channel and author kind"""
+    __slots__ = ('everywhere', 'by_channel', 'cache')
+
+    def __init__(self, guild_id):
+        self.everywhere = []
+        self.by_channel = collections.defaultdict(list)
+        for feature in message_features:
+            try:
+                channels = feature.channels(guild_id)
+            except Exception as e:
+                print(f"Error resolving {feature.name} for guild {guild_id}: {e}")
+                continue
+            if channels is ALL_CHANNELS:
+                self.everywhere.append(feature)
+            elif channels:
+                for channel_id in channels:
+                    self.by_channel[channel_id].append(feature)
+        self.cache = {}  # {(channel_id, bot, command): stages}
+
+    def lookup(self, channel_id, parent_id, bot, command):
+        """Tuple of stages, each a tuple of handlers to run concurrently; empty when nothing is on"""
+        key = (channel_id, bot, command)
+        stages = self.cache.get(key)
+        if stages is None:
+            features = self.everywhere + self.by_channel.get(channel_id, []) + self.by_channel.get(parent_id, [])
+            features = [feature for feature in dict.fromkeys(features)
+                        if (feature.bots if bot else feature.humans) and (feature.commands or not command)]
+            grouped = itertools.groupby(sorted(features, key=lambda feature: feature.stage),
+                                        key=lambda feature: feature.stage)
+            stages = self.cache[key] = tuple(tuple(feature.handler for feature in group) for _, group in grouped)
+        return stages
+
+guild_message_routes = {}  # {guild_id: MessageRoutes}, built on the first message after a change
+
+def message_routes(guild_id):
+    routes = guild_message_routes.get(guild_id)
+    if routes is None:
+        routes = guild_message_routes[guild_id] = MessageRoutes(guild_id)
+    return routes
+
+def invalidate_message_routes(guild_id):
+    """Rebuild a guild's routes on its next message, after one of its feature configs changed"""
+    guild_message_routes.pop(int(guild_id), None)
+
+async def run_message_handlers(handlers, message):
+    """Run one stage of handlers concurrently; True when one of them removed the message"""
+    if len(handlers) == 1:
+        try:
+            return await handlers[0](message) is True
+        except Exception as e:
+            print(f"Error in {handlers[0].__name__}: {e}")
+            return False
+    results = await asyncio.gather(*(handler(message) for handler in handlers), return_exceptions=True)
+    for handler, result in zip(handlers, results):
+        if isinstance(result, Exception):
+            print(f"Error in {handler.__name__}: {result}")
+    return any(result is True for result in results)
+
+async def antispam_message_handler(message):
+    """Raid counters and the anti-spam rule pipeline for a member's message"""
+    rules = get_antispam_rules(message.guild.id)
+    if rules.raid is not None and await track_raid_message(message, rules):
+        return True
+    if not rules.checks or rules.exempt(message):
+        return False
+    user_id = message.author.id
+    current_time = time.time()
+    fingerprint = text_sketch(message.content) if rules.fingerprint else None
+    entry = (current_time, hash(message.content), message.channel.id, message.id, fingerprint, user_id)
+    guild_state = guild_spam_states.touch(message.guild.id)
+    history = guild_state.user_message_history.touch(user_id)
+    history.append(entry)
+    while current_time - history[0][0] > rules.window:
+        history.popleft()
+    if rules.guild_fingerprints and fingerprint is not None:
+        fingerprints = guild_state.fingerprints
+        fingerprints.append(entry)
+        while current_time - fingerprints[0][0] > rules.window:
+            fingerprints.popleft()
+
+    hit = rules.evaluate(message, history, guild_state, current_time)
+    if hit is None:
+        return False
+    rule_name, action, entries = hit
+    spam_rule_hits.setdefault(message.guild.id, collections.Counter())[rule_name] += 1
+    history.clear()
+    guild_state.forget(entries)
+    if rules.shadow:
+        print(f"[shadow] Anti-spam rule {rule_name} matched {message.author.name} (ID: {user_id})")
+        return False
+    await apply_spam_action(message, rule_name, action, entries, rules)
+    return True
+
+async def bot_antispam_message_handler(message):
+    """Blocklist and flood protection for a bot's or webhook's message"""
+    rules = get_antispam_rules(message.guild.id)
+    if rules.exempt(message):
+        return False
+    if rules.blocklist is not None and await block_bot_message(message, rules):
+        return True
+    if rules.bot_flood is not None:
+        await track_bot_message(message, rules)
+    return False
+
+async def block_bot_message(message, rules):
+    """Delete a bot or webhook message that trips the blocklist
+
+    Only the message is removed: bots and webhooks cannot be timed out, and
+    repeat offenders are left to the bot flood rule's kick/ban.
+    """
+    entry = (time.time(), None, message.channel.id, message.id, None, message.author.id)
+    if not rules.blocklist(message, [entry], None, entry[0]):
+        return False
+    spam_rule_hits.setdefault(message.guild.id, collections.Counter())['blocklist'] += 1
+    kind = 'Webhook' if message.webhook_id else 'Bot'
+    if rules.shadow:
+        print(f"[shadow] Anti-spam rule blocklist matched {kind.lower()} {message.author.name}")
+        return False
+    try:
+        await message.delete()
+        print(f"Deleted blocked {kind.lower()} message from {message.author.name} (ID: {message.author.id})")
+    except discord.NotFound:
+        pass
+    except discord.Forbidden as e:
+        print(f"Failed to delete {kind.lower()} message from {message.author.name} - insufficient permissions: {e}")
+        return False
+    return True
+
+def antispam_channels(guild_id):
+    rules = get_antispam_rules(guild_id)
+    return ALL_CHANNELS if rules.checks or rules.raid is not None else None
+
+def bot_antispam_channels(guild_id):
+    rules = get_antispam_rules(guild_id)
+    return ALL_CHANNELS if rules.blocklist is not None or rules.bot_flood is not None else None
 
-    await bot.process_commands(message)
+register_message_feature('antispam', antispam_message_handler, antispam_channels)
+register_message_feature('bot_antispam', bot_antispam_message_handler, bot_antispam_channels,
+                         humans=False, bots=True)
+antispam_rules.subscribe(lambda guild_id, config: invalidate_message_routes(guild_id))
+
+@bot.event
+async def on_message(message):
+    if message.author == bot.user:
+        return
+
+    if message.guild is not None:
+        channel = message.channel
+        stages = message_routes(message.guild.id).lookup(
+            channel.id, getattr(channel, 'parent_id', None), message.author.bot,
+            message.content.startswith(bot.command_prefix))
+        for handlers in stages:
+            if await run_message_handlers(handlers, message):
+                return
+
+    if message.content.startswith(bot.command_prefix):
+        await bot.process_commands(message)
 
 class RoleSelectionView(discord.ui.View):
     def __init__(self, available_roles):
@@ -273,18 +2851,7 @@ class RoleSelectionView(discord.ui.View):
 
             await interaction.user.add_roles(role)
 
-            data = load_data()
-            user_id = str(interaction.user.id)
-
-            if user_id not in data['users']:
-                data['users'][user_id] = {
-                    'authenticated': True,
-                    'join_date': datetime.now().isoformat()
-                }
-            else:
-                data['users'][user_id]['authenticated'] = True
-
-            save_data(data)
+            data_store.authenticate_user(interaction.user.id)
 
             await interaction.response.send_message(f'✅ {role.name} ロールが付与されました！', ephemeral=True)
 
@@ -300,18 +2867,7 @@ class SpecificRoleView(discord.ui.View):
 
     @discord.ui.button(label='ろーるをしゅとく！', style=discord.ButtonStyle.primary, custom_id='specific_role_button')
     async def get_role_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        data = load_data()
-        user_id = str(interaction.user.id)
-
-        if user_id not in data['users']:
-            data['users'][user_id] = {
-                'authenticated': True,
-                'join_date': datetime.now().isoformat()
-            }
-        else:
-            data['users'][user_id]['authenticated'] = True
-
-        save_data(data)
+        data_store.authenticate_user(interaction.user.id)
 
         try:
             if self.role in interaction.user.roles:
@@ -332,18 +2888,7 @@ class PublicAuthView(discord.ui.View):
 
     @discord.ui.button(label='認証する', style=discord.ButtonStyle.primary, custom_id='public_auth_button')
     async def authenticate_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        data = load_data()
-        user_id = str(interaction.user.id)
-
-        if user_id not in data['users']:
-            data['users'][user_id] = {
-                'authenticated': True,
-                'join_date': datetime.now().isoformat()
-            }
-        else:
-            data['users'][user_id]['authenticated'] = True
-
-        save_data(data)
+        data_store.authenticate_user(interaction.user.id)
 
         assignable_roles = []
         for role in interaction.guild.roles:
@@ -432,15 +2977,12 @@ async def view_profile(interaction: discord.Interaction, user: discord.Member =
     if user is None:
         user = interaction.user
 
-    data = load_data()
-    user_id = str(user.id)
+    user_data = data_store.get_user(user.id)
 
-    if user_id not in data['users']:
+    if user_data is None:
         await interaction.response.send_message('❌ ユーザーが見つかりません。')
         return
 
-    user_data = data['users'][user_id]
-
     embed = discord.Embed(
         title=f'👤 {user.display_name} のプロフィール',
         color=0x00ff00
@@ -491,14 +3033,8 @@ async def setup_role(interaction: discord.Interaction, role_name: str = None):
             message = await interaction.followup.send(embed=embed, view=view)
             
             # Save persistent view data
-            persistent_views[f"specific_role_{message.id}"] = {
-                'type': 'specific_role',
-                'role_id': str(role.id),
-                'guild_id': str(interaction.guild.id),
-                'channel_id': str(interaction.channel.id),
-                'message_id': str(message.id)
-            }
-            save_persistent_views()
+            persistent_views[f"specific_role_{message.id}"] = PersistentViewRecord(
+                'specific_role', interaction.guild.id, interaction.channel.id, message.id, role_id=role.id)
         else:
             embed = discord.Embed(
                 title='🎭 ロール取得システム',
@@ -515,13 +3051,8 @@ async def setup_role(interaction: discord.Interaction, role_name: str = None):
             message = await interaction.followup.send(embed=embed, view=view)
             
             # Save persistent view data
-            persistent_views[f"public_auth_{message.id}"] = {
-                'type': 'public_auth',
-                'guild_id': str(interaction.guild.id),
-                'channel_id': str(interaction.channel.id),
-                'message_id': str(message.id)
-            }
-            save_persistent_views()
+            persistent_views[f"public_auth_{message.id}"] = PersistentViewRecord(
+                'public_auth', interaction.guild.id, interaction.channel.id, message.id)
     except Exception as e:
         print(f"Error in setuprole command: {e}")
         try:
@@ -570,41 +3101,249 @@ async def view_servers(interaction: discord.Interaction, user: discord.Member =
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name='antispam-config', description='荒らし対策設定を表示・変更')
-async def antispam_config(interaction: discord.Interaction, action: str = "show"):
+async def antispam_config(interaction: discord.Interaction, action: str = "show", rule: str = None,
+                          value: str = None, channel: discord.TextChannel = None, role: discord.Role = None):
     if not interaction.user.guild_permissions.manage_messages:
         await interaction.response.send_message('❌ メッセージ管理権限が必要です。', ephemeral=True)
         return
 
+    guild_key = str(interaction.guild.id)
+    config = normalize_antispam_rules(antispam_rules.get(guild_key, {}))
+
     if action == "show":
         embed = discord.Embed(
             title="🛡️ 荒らし対策設定",
             description="現在の荒らし対策設定:",
             color=0x0099ff
         )
+        hits = spam_rule_hits.get(interaction.guild.id, {})
+        for name, settings in config['rules'].items():
+            if 'count' in settings:
+                condition = (f"• {settings['window']:g}秒以内に{settings['count']}"
+                             f"{'人' if name == 'raid_similar' else '回'}以上: {SPAM_ACTIONS[settings['action']]}\n")
+            else:
+                condition = (f"• 禁止ワード{len(settings['words'])}件 / ドメイン{len(settings['domains'])}件 / "
+                             f"招待{len(settings['invites'])}件"
+                             f"{'（全ての招待リンクを禁止）' if settings['all_invites'] else ''}: "
+                             f"{SPAM_ACTIONS[settings['action']]}\n")
+            embed.add_field(
+                name=f"{SPAM_RULE_LABELS[name]} ({name})",
+                value=(f"{'🟢 有効' if settings['enabled'] else '⚪ 無効'}\n" + condition
+                       + (f"• 類似判定: 一致度{settings['similarity']}%以上\n" if 'similarity' in settings else '')
+                       + f"• 検知回数: {hits.get(name, 0)}回"),
+                inline=False
+            )
+        embed.add_field(name="タイムアウト時間", value=f"{config['timeout_minutes']}分", inline=True)
+        embed.add_field(name="シャドーモード", value="🟡 オン（検知のみ）" if config['shadow'] else "オフ", inline=True)
+        embed.add_field(name="対象外チャンネル",
+                        value=' '.join(f'<#{channel_id}>' for channel_id in config['exempt_channels']) or 'なし',
+                        inline=False)
+        embed.add_field(name="対象外ロール",
+                        value=' '.join(f'<@&{role_id}>' for role_id in config['exempt_roles']) or 'なし',
+                        inline=False)
+        raid = config['raid']
         embed.add_field(
-            name="同一メッセージ連投検知",
-            value="• 30秒以内に同じメッセージを3回以上: 全て削除 + 1時間タイムアウト",
-            inline=False
-        )
-        embed.add_field(
-            name="Bot対策",
-            value="• 2連続以上のメッセージでBan",
+            name="レイド検知 (raid)",
+            value=(f"{'🟢 有効' if raid['enabled'] else '⚪ 無効'}\n"
+                   + ''.join(f"• {RAID_METRICS[metric]} ({metric}): "
+                             f"{f'{threshold}以上' if threshold else '無効'}\n"
+                             for metric, threshold in raid['thresholds'].items())
+                   + f"• 新規メンバー: 参加後{raid['new_member_minutes']}分以内\n"
+                   + f"• レイドモード: {raid['duration_minutes']}分間 / "
+                   + (', '.join(RAID_RESPONSES[response] for response in raid['responses']) or '対応なし')
+                   + f"\n• 検知回数: {hits.get('raid', 0)}回"),
             inline=False
         )
+        bot_flood = config['bot_flood']
         embed.add_field(
-            name="自動削除",
-            value="• スパムメッセージは自動削除",
+            name="Bot・Webhookの大量投稿 (bot-flood)",
+            value=(f"{'🟢 有効' if bot_flood['enabled'] else '⚪ 無効'}\n"
+                   f"• 連続{bot_flood['burst']}件まで、その後は毎秒{bot_flood['rate']:g}件まで\n"
+                   f"• 超えた場合: 全て削除 + {BOT_FLOOD_ACTIONS[bot_flood['action']]}\n"
+                   f"• 検知回数: {hits.get('bot_flood', 0)}回"),
             inline=False
         )
 
         await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
 
-    elif action == "reset":
-        global user_message_history, bot_message_count
-        user_message_history.clear()
-        bot_message_count.clear()
+    if action == "reset":
+        guild_spam_states.discard(interaction.guild.id)
+        spam_rule_hits.pop(interaction.guild.id, None)
+
+        await interaction.response.send_message('✅ このサーバーの荒らし対策データをリセットしました。', ephemeral=True)
+        return
+
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message('❌ ルールの変更にはサーバー管理権限が必要です。', ephemeral=True)
+        return
+
+    try:
+        if action in ("enable", "disable", "count", "window", "similarity", "penalty"):
+            if rule not in config['rules']:
+                await interaction.response.send_message(
+                    f"❌ ruleには {' / '.join(config['rules'])} のいずれかを指定してください。", ephemeral=True)
+                return
+            settings = config['rules'][rule]
+            if action in ("enable", "disable"):
+                settings['enabled'] = action == "enable"
+            elif action == "count":
+                number = int(value)
+                if 'count' not in settings or not 2 <= number <= SPAM_HISTORY_SIZE:
+                    raise ValueError
+                settings['count'] = number
+            elif action == "window":
+                number = float(value)
+                if 'window' not in settings or not 1 <= number <= SPAM_MAX_WINDOW:
+                    raise ValueError
+                settings['window'] = number
+            elif action == "similarity":
+                number = int(value)
+                if 'similarity' not in settings or not 1 <= number <= 100:
+                    raise ValueError
+                settings['similarity'] = number
+            else:
+                if value not in SPAM_ACTIONS:
+                    await interaction.response.send_message(
+                        f"❌ valueには {' / '.join(SPAM_ACTIONS)} のいずれかを指定してください。", ephemeral=True)
+                    return
+                settings['action'] = value
+        elif action in ("block", "unblock"):
+            kinds = {'word': ('words', str.casefold), 'domain': ('domains', normalize_domain),
+                     'invite': ('invites', normalize_invite)}
+            if rule not in kinds or not value or not kinds[rule][1](value.strip()):
+                await interaction.response.send_message(
+                    '❌ ruleには word / domain / invite のいずれか、valueには対象の文字列を指定してください。',
+                    ephemeral=True)
+                return
+            key, normalize = kinds[rule]
+            blocklist = set(config['rules']['blocklist'][key])
+            if action == "block":
+                if len(blocklist) >= BLOCKLIST_MAX_PATTERNS:
+                    await interaction.response.send_message(
+                        f'❌ 登録できるのは{BLOCKLIST_MAX_PATTERNS}件までです。', ephemeral=True)
+                    return
+                blocklist.add(normalize(value.strip()))
+            else:
+                blocklist.discard(normalize(value.strip()))
+            config['rules']['blocklist'][key] = blocklist
+        elif action == "block-all-invites":
+            if value not in ("on", "off"):
+                await interaction.response.send_message('❌ valueには on / off を指定してください。', ephemeral=True)
+                return
+            config['rules']['blocklist']['all_invites'] = value == "on"
+        elif action == "timeout":
+            number = int(value)
+            if not 1 <= number <= 40320:  # Discord caps timeouts at 28 days
+                raise ValueError
+            config['timeout_minutes'] = number
+        elif action == "shadow":
+            if value not in ("on", "off"):
+                await interaction.response.send_message('❌ valueには on / off を指定してください。', ephemeral=True)
+                return
+            config['shadow'] = value == "on"
+        elif action in ("exempt-channel", "unexempt-channel"):
+            target = (channel or interaction.channel).id
+            exempt = set(config['exempt_channels'])
+            if action == "exempt-channel":
+                exempt.add(target)
+            else:
+                exempt.discard(target)
+            config['exempt_channels'] = exempt
+        elif action in ("exempt-role", "unexempt-role"):
+            if role is None:
+                await interaction.response.send_message('❌ ロールを指定してください。', ephemeral=True)
+                return
+            exempt = set(config['exempt_roles'])
+            if action == "exempt-role":
+                exempt.add(role.id)
+            else:
+                exempt.discard(role.id)
+            config['exempt_roles'] = exempt
+        elif action == "bot-flood":
+            if value not in ("on", "off"):
+                await interaction.response.send_message('❌ valueには on / off を指定してください。', ephemeral=True)
+                return
+            config['bot_flood']['enabled'] = value == "on"
+        elif action == "bot-flood-burst":
+            number = int(value)
+            if not 1 <= number <= BOT_FLOOD_RECENT:
+                raise ValueError
+            config['bot_flood']['burst'] = number
+        elif action == "bot-flood-rate":
+            number = float(value)
+            if not 0.01 <= number <= 100:
+                raise ValueError
+            config['bot_flood']['rate'] = number
+        elif action == "bot-flood-penalty":
+            if value not in BOT_FLOOD_ACTIONS:
+                await interaction.response.send_message(
+                    f"❌ valueには {' / '.join(BOT_FLOOD_ACTIONS)} のいずれかを指定してください。", ephemeral=True)
+                return
+            config['bot_flood']['action'] = value
+        elif action == "raid":
+            if value not in ("on", "off"):
+                await interaction.response.send_message('❌ valueには on / off を指定してください。', ephemeral=True)
+                return
+            config['raid']['enabled'] = value == "on"
+        elif action == "raid-threshold":
+            if rule not in RAID_METRICS:
+                await interaction.response.send_message(
+                    f"❌ ruleには {' / '.join(RAID_METRICS)} のいずれかを指定してください。", ephemeral=True)
+                return
+            number = int(value)
+            if number < 0:
+                raise ValueError
+            config['raid']['thresholds'][rule] = number
+        elif action == "raid-response":
+            if rule not in RAID_RESPONSES or value not in ("on", "off"):
+                await interaction.response.send_message(
+                    f"❌ ruleには {' / '.join(RAID_RESPONSES)} のいずれか、valueには on / off を指定してください。",
+                    ephemeral=True)
+                return
+            responses = set(config['raid']['responses'])
+            if value == "on":
+                responses.add(rule)
+            else:
+                responses.discard(rule)
+            config['raid']['responses'] = responses
+        elif action in ("raid-duration", "raid-new-member"):
+            number = int(value)
+            if not 0 <= number <= 1440 or (action == "raid-duration" and number < 1):
+                raise ValueError
+            config['raid']['duration_minutes' if action == "raid-duration" else 'new_member_minutes'] = number
+        elif action == "raid-end":
+            state = guild_spam_states.get(interaction.guild.id)
+            if state is None or not state.raid.active(time.monotonic()):
+                await interaction.response.send_message('❌ レイドモードは有効になっていません。', ephemeral=True)
+                return
+            await interaction.response.send_message('✅ レイドモードを解除しました。', ephemeral=True)
+            await end_raid_mode(interaction.guild, state.raid)
+            return
+        elif action == "reset-rules":
+            if guild_key in antispam_rules:
+                del antispam_rules[guild_key]
+            await interaction.response.send_message('✅ 荒らし対策ルールを初期設定に戻しました。', ephemeral=True)
+            return
+        else:
+            await interaction.response.send_message(
+                '❌ actionは show / reset / enable / disable / count / window / similarity / penalty / block / unblock / '
+                'block-all-invites / timeout / shadow / '
+                'exempt-channel / unexempt-channel / exempt-role / unexempt-role / bot-flood / bot-flood-burst / '
+                'bot-flood-rate / bot-flood-penalty / raid / raid-threshold / '
+                'raid-response / raid-duration / raid-new-member / raid-end / reset-rules '
+                'のいずれかを指定してください。', ephemeral=True)
+            return
+    except (TypeError, ValueError):
+        await interaction.response.send_message(
+            f'❌ 値が正しくありません。回数は2〜{SPAM_HISTORY_SIZE}、秒数は1〜{SPAM_MAX_WINDOW}、'
+            '類似判定の一致度は1〜100%（similar / raid_similarのみ）、タイムアウトは1〜40320分、'
+            f'Botの連続投稿数は1〜{BOT_FLOOD_RECENT}件、毎秒の投稿数は0.01〜100件、'
+            'レイドのしきい値は0以上、レイドモードの時間は1〜1440分で指定してください。', ephemeral=True)
+        return
 
-        await interaction.response.send_message('✅ 荒らし対策データをリセットしました。', ephemeral=True)
+    antispam_rules[guild_key] = config
+    await interaction.response.send_message('✅ 荒らし対策ルールを更新しました。', ephemeral=True)
 
 @bot.tree.command(name='spam-status', description='現在のスパム検知状況を表示')
 async def spam_status(interaction: discord.Interaction):
@@ -617,12 +3356,27 @@ async def spam_status(interaction: discord.Interaction):
         color=0x00ff00
     )
 
-    active_users = len([uid for uid, history in user_message_history.items() if history])
-    tracked_bots = len(bot_message_count)
+    guild_spam_states.sweep()
+    state = guild_spam_states.get(interaction.guild.id)
+    if state is not None:
+        state.sweep()
+    active_users = len(state.user_message_history) if state else 0
+    tracked_bots = len(state.bot_buckets) if state else 0
 
     embed.add_field(name="監視中ユーザー", value=f"{active_users}人", inline=True)
     embed.add_field(name="追跡中Bot", value=f"{tracked_bots}個", inline=True)
     embed.add_field(name="システム状態", value="🟢 稼働中", inline=True)
+    if state is not None:
+        now = time.monotonic()
+        raid_state = state.raid
+        remaining = raid_state.until - now
+        embed.add_field(name="レイドモード",
+                        value=f"🚨 有効（残り{int(remaining // 60)}分{int(remaining % 60)}秒）" if remaining > 0 else "オフ",
+                        inline=False)
+        embed.add_field(name="直近の活動",
+                        value='\n'.join(f"• {RAID_METRICS[metric]}: {getattr(raid_state, metric).value(now)}"
+                                         for metric in RAID_METRICS),
+                        inline=False)
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
@@ -806,48 +3560,243 @@ async def giveaway(interaction: discord.Interaction, prize: str):
 # Level and Experience System
 def add_experience(user_id, guild_id, amount):
     """Add experience to user and check for level up"""
-    data = load_data()
-    if 'user_levels' not in data:
-        data['user_levels'] = {}
-    
-    guild_key = str(guild_id)
-    user_key = str(user_id)
-    
-    if guild_key not in data['user_levels']:
-        data['user_levels'][guild_key] = {}
-    
-    if user_key not in data['user_levels'][guild_key]:
-        data['user_levels'][guild_key][user_key] = {'level': 1, 'xp': 0, 'total_xp': 0}
-    
-    user_data = data['user_levels'][guild_key][user_key]
-    user_data['xp'] += amount
-    user_data['total_xp'] += amount
-    
-    # Calculate level (100 XP per level)
-    new_level = (user_data['total_xp'] // 100) + 1
-    
-    if new_level > user_data['level']:
-        user_data['level'] = new_level
-        user_data['xp'] = user_data['total_xp'] % 100
-        save_data(data)
-        return new_level  # Return new level for level up message
-    
-    save_data(data)
-    return None
+    return data_store.add_experience(guild_id, user_id, amount)  # New level for level up message
 
 def get_user_level_data(user_id, guild_id):
     """Get user level data"""
-    data = load_data()
-    if 'user_levels' not in data:
-        return {'level': 1, 'xp': 0, 'total_xp': 0}
-    
-    guild_key = str(guild_id)
-    user_key = str(user_id)
-    
-    if guild_key not in data['user_levels'] or user_key not in data['user_levels'][guild_key]:
-        return {'level': 1, 'xp': 0, 'total_xp': 0}
-    
-    return data['user_levels'][guild_key][user_key]
+    return data_store.get_level(guild_id, user_id) or {'level': 1, 'xp': 0, 'total_xp': 0}
+
+class XpAccumulator:
+    """Sums chat XP per (guild, user) and applies it to the data store in batches
+
+    Message XP costs a dict increment; every XP_BATCH_INTERVAL seconds the
+    summed deltas are applied and the resulting level-ups announced in the
+    channel the user last talked in.
+    """
+
+    def __init__(self, store, interval=XP_BATCH_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self.pending = {}  # {(guild_id, user_id): summed XP}
+        self.channels = {}  # {(guild_id, user_id): channel of the latest message}
+        self._task = None
+
+    def add(self, guild_id, user_id, amount, channel_id=None):
+        key = (guild_id, user_id)
+        self.pending[key] = self.pending.get(key, 0) + amount
+        if channel_id is not None:
+            self.channels[key] = channel_id
+
+    def discard_guild(self, guild_id):
+        """Drop a guild's batched XP (the bot left it)"""
+        for key in [key for key in self.pending if key[0] == guild_id]:
+            del self.pending[key]
+            self.channels.pop(key, None)
+
+    def apply(self):
+        """Apply pending XP and return level-ups as (guild_id, user_id, channel_id, new_level)"""
+        pending, self.pending = self.pending, {}
+        channels, self.channels = self.channels, {}
+        level_ups = []
+        for (guild_id, user_id), amount in pending.items():
+            new_level = self.store.add_experience(guild_id, user_id, amount)
+            if new_level:
+                level_ups.append((guild_id, user_id, channels.get((guild_id, user_id)), new_level))
+        return level_ups
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._apply_loop())
+
+    async def _apply_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await announce_level_ups(self.apply())
+                prune_xp_cooldowns()
+            except Exception as e:
+                print(f"Error applying XP batch: {e}")
+
+async def announce_level_ups(level_ups):
+    for guild_id, user_id, channel_id, new_level in level_ups:
+        channel = bot.get_channel(channel_id) if channel_id else None
+        if channel is None:
+            continue
+        try:
+            await channel.send(f'🎉 <@{user_id}> がレベル {new_level} に上がりました！')
+        except discord.HTTPException as e:
+            print(f"Failed to announce level up in {channel_id}: {e}")
+
+xp_accumulator = XpAccumulator(data_store)
+
+DEFAULT_XP_PER_MESSAGE = 5
+
+def xp_number(value):
+    """A finite, non-negative XP setting; ValueError otherwise (negative XP would drain totals)"""
+    number = float(value)
+    if not math.isfinite(number) or number < 0:
+        raise ValueError(f'XP settings must be finite and 0 or more, got {value!r}')
+    return number
+
+def normalize_xp_rules(config):
+    """Fill defaults and coerce a guild's XP rules to JSON-friendly types"""
+    return {
+        'base_xp': int(xp_number(config.get('base_xp', DEFAULT_XP_PER_MESSAGE))),
+        'cooldown': xp_number(config.get('cooldown', 0)),
+        'min_length': int(xp_number(config.get('min_length', 0))),
+        'ignored_channels': sorted({int(channel_id) for channel_id in config.get('ignored_channels', [])}),
+        'channel_multipliers': {str(int(channel_id)): xp_number(multiplier)
+                                for channel_id, multiplier in config.get('channel_multipliers', {}).items()},
+        'role_multipliers': {str(int(role_id)): xp_number(multiplier)
+                             for role_id, multiplier in config.get('role_multipliers', {}).items()}
+    }
+
+xp_rules = config_registry.register('xp_rules', 'xp_rules.json', normalize_xp_rules)  # {guild_id: rules}
+
+@dataclass(slots=True)
+class CompiledXpRules:
+    """A guild's XP rules as set/dict lookups for the on_message hot path"""
+    base_xp: int
+    cooldown: float
+    min_length: int
+    ignored_channels: frozenset
+    channel_multipliers: dict  # {channel_id: multiplier}
+    role_multipliers: dict  # {role_id: multiplier}
+
+    @classmethod
+    def compile(cls, rules):
+        return cls(rules['base_xp'], rules['cooldown'], rules['min_length'],
+                   frozenset(rules['ignored_channels']),
+                   {int(channel_id): multiplier for channel_id, multiplier in rules['channel_multipliers'].items()},
+                   {int(role_id): multiplier for role_id, multiplier in rules['role_multipliers'].items()})
+
+DEFAULT_XP_RULES = CompiledXpRules.compile(normalize_xp_rules({}))
+compiled_xp_rules = {}  # {guild_id: CompiledXpRules}, compiled on first use
+xp_cooldowns = {}  # {(guild_id, user_id): time the user can earn chat XP again}
+
+def get_xp_rules(guild_id):
+    rules = compiled_xp_rules.get(guild_id)
+    if rules is None:
+        config = xp_rules.get(str(guild_id))
+        rules = DEFAULT_XP_RULES if config is None else CompiledXpRules.compile(config)
+        compiled_xp_rules[guild_id] = rules
+    return rules
+
+def on_xp_rules_changed(guild_id, config):
+    """Recompile on the next message after a guild's rules change"""
+    compiled_xp_rules.pop(int(guild_id), None)
+
+xp_rules.subscribe(on_xp_rules_changed)
+
+def message_xp(message):
+    """XP a chat message earns under its guild's rules (0 when it earns nothing)"""
+    rules = get_xp_rules(message.guild.id)
+    channel = message.channel
+    parent_id = getattr(channel, 'parent_id', None)  # Threads follow their parent channel's rules
+    if channel.id in rules.ignored_channels or parent_id in rules.ignored_channels:
+        return 0
+    if len(message.content) < rules.min_length:
+        return 0
+    if rules.cooldown:
+        key = (message.guild.id, message.author.id)
+        now = time.monotonic()
+        if xp_cooldowns.get(key, 0) > now:
+            return 0
+        xp_cooldowns[key] = now + rules.cooldown
+    multiplier = rules.channel_multipliers.get(channel.id, rules.channel_multipliers.get(parent_id, 1.0))
+    if rules.role_multipliers and isinstance(message.author, discord.Member):
+        multiplier *= max((role_multiplier for role_id, role_multiplier in rules.role_multipliers.items()
+                           if message.author.get_role(role_id)), default=1.0)
+    return int(rules.base_xp * multiplier)
+
+async def xp_message_handler(message):
+    if message.content.startswith('/'):
+        return
+    amount = message_xp(message)
+    if amount:
+        xp_accumulator.add(message.guild.id, message.author.id, amount, message.channel.id)
+
+# Runs after moderation so removed spam earns nothing
+register_message_feature('xp', xp_message_handler, lambda guild_id: ALL_CHANNELS, stage=1)
+
+def prune_xp_cooldowns():
+    now = time.monotonic()
+    for key in [key for key, ready_at in xp_cooldowns.items() if ready_at <= now]:
+        del xp_cooldowns[key]
+
+@bot.tree.command(name='xp-config', description='経験値の獲得ルールを表示・変更')
+async def xp_config(interaction: discord.Interaction, action: str = "show", value: str = None,
+                    channel: discord.TextChannel = None, role: discord.Role = None):
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message('❌ サーバー管理権限が必要です。', ephemeral=True)
+        return
+
+    guild_key = str(interaction.guild.id)
+    rules = normalize_xp_rules(xp_rules.get(guild_key, {}))
+
+    if action == "show":
+        embed = discord.Embed(title="⭐ 経験値ルール", color=0x00ff99)
+        embed.add_field(name="基本XP", value=f"{rules['base_xp']} XP / メッセージ", inline=True)
+        embed.add_field(name="クールダウン", value=f"{rules['cooldown']:g}秒", inline=True)
+        embed.add_field(name="最小文字数", value=f"{rules['min_length']}文字", inline=True)
+        embed.add_field(name="対象外チャンネル",
+                        value=' '.join(f'<#{channel_id}>' for channel_id in rules['ignored_channels']) or 'なし',
+                        inline=False)
+        embed.add_field(name="チャンネル倍率",
+                        value='\n'.join(f'<#{channel_id}>: ×{multiplier:g}'
+                                        for channel_id, multiplier in rules['channel_multipliers'].items()) or 'なし',
+                        inline=False)
+        embed.add_field(name="ロール倍率",
+                        value='\n'.join(f'<@&{role_id}>: ×{multiplier:g}'
+                                        for role_id, multiplier in rules['role_multipliers'].items()) or 'なし',
+                        inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    try:
+        if action in ("base", "cooldown", "min-length"):
+            number = xp_number(value)
+            rules[{"base": "base_xp", "cooldown": "cooldown", "min-length": "min_length"}[action]] = number
+        elif action in ("ignore", "unignore"):
+            target = (channel or interaction.channel).id
+            ignored = set(rules['ignored_channels'])
+            if action == "ignore":
+                ignored.add(target)
+            else:
+                ignored.discard(target)
+            rules['ignored_channels'] = ignored
+        elif action == "channel-multiplier":
+            target = str((channel or interaction.channel).id)
+            multiplier = xp_number(value)
+            if multiplier == 1:
+                rules['channel_multipliers'].pop(target, None)
+            else:
+                rules['channel_multipliers'][target] = multiplier
+        elif action == "role-multiplier":
+            if role is None:
+                await interaction.response.send_message('❌ ロールを指定してください。', ephemeral=True)
+                return
+            multiplier = xp_number(value)
+            if multiplier == 1:
+                rules['role_multipliers'].pop(str(role.id), None)
+            else:
+                rules['role_multipliers'][str(role.id)] = multiplier
+        elif action == "reset":
+            if guild_key in xp_rules:
+                del xp_rules[guild_key]
+            await interaction.response.send_message('✅ 経験値ルールを初期設定に戻しました。', ephemeral=True)
+            return
+        else:
+            await interaction.response.send_message(
+                '❌ actionは show / base / cooldown / min-length / ignore / unignore / '
+                'channel-multiplier / role-multiplier / reset のいずれかを指定してください。', ephemeral=True)
+            return
+    except (TypeError, ValueError):
+        await interaction.response.send_message('❌ 値には0以上の数値を指定してください。', ephemeral=True)
+        return
+
+    xp_rules[guild_key] = rules
+    await interaction.response.send_message('✅ 経験値ルールを更新しました。', ephemeral=True)
 
 @bot.tree.command(name='level', description='ユーザーのレベルを表示')
 async def level_command(interaction: discord.Interaction, user: discord.Member = None):
@@ -865,6 +3814,8 @@ async def level_command(interaction: discord.Interaction, user: discord.Member =
     embed.add_field(name='🎯 レベル', value=f"{current_level}", inline=True)
     embed.add_field(name='⭐ 経験値', value=f"{level_data['xp']}/100 XP", inline=True)
     embed.add_field(name='📈 総経験値', value=f"{level_data['total_xp']} XP", inline=True)
+    rank = data_store.level_rank(interaction.guild.id, target_user.id)
+    embed.add_field(name='🏅 サーバー内順位', value=f"{rank}位" if rank else 'ランク外', inline=True)
     embed.add_field(name='🚀 次のレベルまで', value=f"{xp_needed} XP", inline=False)
     
     # Progress bar
@@ -879,36 +3830,242 @@ async def level_command(interaction: discord.Interaction, user: discord.Member =
     
     await interaction.response.send_message(embed=embed)
 
+class TtlCache:
+    """Mapping whose entries expire ttl seconds after they are set, bounded to max_size"""
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()  # {key: (expires_at, value)}, oldest first
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return default
+        return entry[1]
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+RANKING_PAGE_SIZE = 10
+RANKING_PAGE_TTL = 30  # seconds a rendered leaderboard slice is reused
+MEMBER_NAME_TTL = 600  # seconds a resolved display name is reused
+
+ranking_pages = TtlCache(RANKING_PAGE_TTL, max_size=1000)  # {(guild_id, page): (total, rows)}
+member_names = TtlCache(MEMBER_NAME_TTL, max_size=50000)  # {(guild_id, user_id): display name}
+
+def ranking_page(guild_id, page):
+    """(users on the leaderboard, rows of one page), from the slice cache when fresh"""
+    cached = ranking_pages.get((guild_id, page))
+    if cached is None:
+        cached = (data_store.level_count(guild_id),
+                  data_store.top_levels(guild_id, RANKING_PAGE_SIZE, page * RANKING_PAGE_SIZE))
+        ranking_pages.set((guild_id, page), cached)
+    return cached
+
+async def resolve_member_names(guild, user_ids):
+    """Display names for user_ids; members missing from the cache are resolved in one batch"""
+    names = {}
+    missing = []
+    for user_id in user_ids:
+        name = member_names.get((guild.id, user_id))
+        if name is None:
+            member = guild.get_member(user_id)
+            if member is not None:
+                name = member.display_name
+                member_names.set((guild.id, user_id), name)
+        if name is None:
+            missing.append(user_id)
+        else:
+            names[user_id] = name
+    if not missing:
+        return names
+
+    try:
+        members = await guild.query_members(user_ids=missing, limit=len(missing), cache=True)
+    except (discord.ClientException, discord.HTTPException, asyncio.TimeoutError):
+        # No gateway query available: fall back to concurrent REST lookups
+        results = await asyncio.gather(*(guild.fetch_member(user_id) for user_id in missing),
+                                       return_exceptions=True)
+        members = [member for member in results if isinstance(member, discord.Member)]
+    for member in members:
+        names[member.id] = member.display_name
+    for user_id in missing:
+        if user_id not in names:
+            user = bot.get_user(user_id)
+            names[user_id] = user.display_name if user else '不明なユーザー'
+        member_names.set((guild.id, user_id), names[user_id])
+    return names
+
+GLOBAL_RANKING_DEPTH = 100  # entries taken from each guild and kept in the global board
+GLOBAL_RANKING_TTL = 60  # seconds between global board refreshes
+
+class GlobalLeaderboard:
+    """Cross-guild leaderboard built by a k-way merge of per-guild top-XP views
+
+    Each guild contributes its top GLOBAL_RANKING_DEPTH (user_id, total_xp)
+    entries, cached and re-read only when the store's level version for that
+    guild changes. heapq.merge streams the views in XP order and keeps the
+    first (best) entry per user until the board is full, so a user ranks by
+    their highest guild total.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.views = {}  # {guild_key: (version, [(-total_xp, user_id)])}
+        self.board = []  # [(user_id, total_xp)]
+        self.refreshed_at = None
+
+    def top(self):
+        if self.refreshed_at is None or time.monotonic() - self.refreshed_at >= GLOBAL_RANKING_TTL:
+            self.refresh()
+        return self.board
+
+    def refresh(self):
+        changed = False
+        guild_keys = {str(guild_id) for guild_id in self.store.level_guilds()}
+        for guild_key in set(self.views) - guild_keys:
+            del self.views[guild_key]
+            changed = True
+        for guild_key in guild_keys:
+            version = self.store.level_version(guild_key)
+            cached = self.views.get(guild_key)
+            if cached is None or version is None or cached[0] != version:
+                view = [(-total_xp, user_id)
+                        for user_id, total_xp in self.store.guild_top_levels(guild_key, GLOBAL_RANKING_DEPTH)]
+                self.views[guild_key] = (version, view)
+                changed = True
+        if changed or self.refreshed_at is None:
+            board = []
+            seen = set()
+            for negative_xp, user_id in heapq.merge(*(view for _, view in self.views.values())):
+                if user_id in seen:
+                    continue
+                seen.add(user_id)
+                board.append((user_id, -negative_xp))
+                if len(board) >= GLOBAL_RANKING_DEPTH:
+                    break
+            self.board = board
+        self.refreshed_at = time.monotonic()
+
+global_leaderboard = GlobalLeaderboard(data_store)
+
+async def resolve_user_names(user_ids):
+    """Display names for users anywhere; uncached users are fetched concurrently"""
+    names = {}
+    missing = []
+    for user_id in user_ids:
+        name = member_names.get((None, user_id))
+        if name is None:
+            user = bot.get_user(user_id)
+            if user is not None:
+                name = user.display_name
+                member_names.set((None, user_id), name)
+        if name is None:
+            missing.append(user_id)
+        else:
+            names[user_id] = name
+    results = await asyncio.gather(*(bot.fetch_user(user_id) for user_id in missing), return_exceptions=True)
+    for user_id, user in zip(missing, results):
+        names[user_id] = user.display_name if isinstance(user, discord.User) else '不明なユーザー'
+        member_names.set((None, user_id), names[user_id])
+    return names
+
+def global_ranking_page(page):
+    board = global_leaderboard.top()
+    start = page * RANKING_PAGE_SIZE
+    rows = [(user_id, {'level': level_from_total_xp(total_xp)[0], 'total_xp': total_xp})
+            for user_id, total_xp in board[start:start + RANKING_PAGE_SIZE]]
+    return len(board), rows
+
+async def build_ranking_embed(guild, page, scope='server'):
+    """Leaderboard embed for a page, clamped to the pages that exist; returns (embed, page, pages)"""
+    load_page = global_ranking_page if scope == 'global' else lambda page: ranking_page(guild.id, page)
+    total, rows = load_page(page)
+    pages = max(1, (total + RANKING_PAGE_SIZE - 1) // RANKING_PAGE_SIZE)
+    if page >= pages:
+        page = pages - 1
+        total, rows = load_page(page)
+    user_ids = [int(user_id) for user_id, _ in rows]
+
+    if scope == 'global':
+        names = await resolve_user_names(user_ids)
+        embed = discord.Embed(
+            title='🌐 グローバルレベルランキング',
+            description='全サーバーの上位ユーザー（各ユーザーの最高サーバーXPで集計）',
+            color=0xffd700
+        )
+    else:
+        names = await resolve_member_names(guild, user_ids)
+        embed = discord.Embed(
+            title=f'🏆 {guild.name} レベルランキング',
+            description='サーバー内の上位ユーザー',
+            color=0xffd700
+        )
+    for i, (user_id, level_data) in enumerate(rows):
+        rank = page * RANKING_PAGE_SIZE + i
+        rank_emoji = ['🥇', '🥈', '🥉'][rank] if rank < 3 else f"{rank+1}."
+        embed.add_field(
+            name=f'{rank_emoji} {names[int(user_id)]}',
+            value=f'レベル: {level_data["level"]} | 総XP: {level_data["total_xp"]}',
+            inline=False
+        )
+    embed.set_footer(text=f'ページ {page + 1}/{pages} | メッセージを送信してランキングを上げよう！')
+    return embed, page, pages
+
+class RankingView(discord.ui.View):
+    def __init__(self, author_id, page, pages, scope='server'):
+        super().__init__(timeout=300)
+        self.author_id = author_id
+        self.page = page
+        self.scope = scope
+        self.update_buttons(pages)
+
+    def update_buttons(self, pages):
+        self.previous_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= pages - 1
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message('❌ このランキングを操作できるのはコマンドを実行したユーザーだけです。', ephemeral=True)
+            return False
+        return True
+
+    async def show_page(self, interaction, page):
+        await interaction.response.defer()
+        embed, self.page, pages = await build_ranking_embed(interaction.guild, page, self.scope)
+        self.update_buttons(pages)
+        await interaction.edit_original_response(embed=embed, view=self)
+
+    @discord.ui.button(label='◀ 前へ', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label='次へ ▶', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
 @bot.tree.command(name='ranking', description='サーバーのレベルランキングを表示')
-async def ranking_command(interaction: discord.Interaction):
-    data = load_data()
-    if 'user_levels' not in data or str(interaction.guild.id) not in data['user_levels']:
+async def ranking_command(interaction: discord.Interaction, scope: str = "server", page: int = 1):
+    if scope not in ('server', 'global'):
+        await interaction.response.send_message('❌ 範囲は server または global を指定してください。', ephemeral=True)
+        return
+    if scope == 'server' and data_store.level_count(interaction.guild.id) == 0:
         await interaction.response.send_message('❌ まだレベルデータがありません。', ephemeral=True)
         return
-    
-    guild_data = data['user_levels'][str(interaction.guild.id)]
-    
-    # Sort users by total XP
-    sorted_users = sorted(guild_data.items(), key=lambda x: x[1]['total_xp'], reverse=True)
-    
-    embed = discord.Embed(
-        title=f'🏆 {interaction.guild.name} レベルランキング',
-        description='サーバー内の上位ユーザー',
-        color=0xffd700
-    )
-    
-    for i, (user_id, level_data) in enumerate(sorted_users[:10]):  # Top 10
-        user = interaction.guild.get_member(int(user_id))
-        if user:
-            rank_emoji = ['🥇', '🥈', '🥉'][i] if i < 3 else f"{i+1}."
-            embed.add_field(
-                name=f'{rank_emoji} {user.display_name}',
-                value=f'レベル: {level_data["level"]} | 総XP: {level_data["total_xp"]}',
-                inline=False
-            )
-    
-    embed.set_footer(text='メッセージを送信してランキングを上げよう！')
-    await interaction.response.send_message(embed=embed)
+
+    await interaction.response.defer()
+    embed, page, pages = await build_ranking_embed(interaction.guild, max(page - 1, 0), scope)
+    await interaction.followup.send(embed=embed, view=RankingView(interaction.user.id, page, pages, scope))
 
 # Voting System
 active_polls = {}  # {message_id: poll_data}
@@ -934,38 +4091,22 @@ class PollView(discord.ui.View):
 
     def create_vote_callback(self, option_index):
         async def vote_callback(interaction):
-            data = load_data()
-            if 'polls' not in data:
-                data['polls'] = {}
-            
-            if self.poll_id not in data['polls']:
+            # Record new vote (moves an existing vote)
+            poll = data_store.record_vote(interaction.guild.id, self.poll_id, interaction.user.id, option_index)
+            if poll is None:
                 await interaction.response.send_message('❌ この投票は見つかりません。', ephemeral=True)
                 return
             
-            poll_data = data['polls'][self.poll_id]
-            user_id = str(interaction.user.id)
-            
-            # Check if user already voted
-            if user_id in poll_data['voters']:
-                old_option = poll_data['voters'][user_id]
-                poll_data['votes'][old_option] -= 1
-            
-            # Record new vote
-            poll_data['voters'][user_id] = option_index
-            poll_data['votes'][option_index] += 1
-            
-            save_data(data)
-            
             # Update embed
             embed = discord.Embed(
-                title=f'📊 {poll_data["question"]}',
+                title=f'📊 {poll.question}',
                 description='下のボタンをクリックして投票してください。',
                 color=0x0099ff
             )
             
-            total_votes = sum(poll_data['votes'])
-            for i, option in enumerate(poll_data['options']):
-                votes = poll_data['votes'][i]
+            total_votes = sum(poll.votes)
+            for i, option in enumerate(poll.options):
+                votes = poll.votes[i]
                 percentage = (votes / total_votes * 100) if total_votes > 0 else 0
                 bar_length = 20
                 filled_length = int(bar_length * percentage / 100)
@@ -977,7 +4118,7 @@ class PollView(discord.ui.View):
                     inline=False
                 )
             
-            embed.set_footer(text=f'総投票数: {total_votes}票 | 作成者: {poll_data["creator"]}')
+            embed.set_footer(text=f'総投票数: {total_votes}票 | 作成者: {poll.creator}')
             
             try:
                 await interaction.response.edit_message(embed=embed, view=self)
@@ -1030,27 +4171,15 @@ async def poll_command(interaction: discord.Interaction, question: str, options:
         
         # Get message and update poll data
         message = await interaction.original_response()
-        poll_id = str(message.id)
+        poll_id = message.id
         
         # Update view with correct poll ID
         view.poll_id = poll_id
         await message.edit(view=view)
         
         # Save poll data
-        data = load_data()
-        if 'polls' not in data:
-            data['polls'] = {}
-            
-        data['polls'][poll_id] = {
-            'question': question,
-            'options': option_list,
-            'votes': [0] * len(option_list),
-            'voters': {},  # {user_id: option_index}
-            'creator': interaction.user.display_name,
-            'channel_id': interaction.channel.id,
-            'guild_id': interaction.guild.id
-        }
-        save_data(data)
+        data_store.create_poll(Poll(poll_id, interaction.guild.id, interaction.channel.id, question,
+                                    option_list, interaction.user.display_name))
         
         # Add XP for creating poll
         add_experience(interaction.user.id, interaction.guild.id, 20)
@@ -1067,23 +4196,21 @@ async def poll_command(interaction: discord.Interaction, question: str, options:
 
 @bot.tree.command(name='poll-results', description='投票結果を表示')
 async def poll_results_command(interaction: discord.Interaction, poll_id: str):
-    data = load_data()
-    if 'polls' not in data or poll_id not in data['polls']:
+    poll = data_store.get_poll(interaction.guild.id, poll_id) if poll_id.isdigit() else None
+    if poll is None:
         await interaction.response.send_message('❌ 指定された投票が見つかりません。', ephemeral=True)
         return
     
-    poll_data = data['polls'][poll_id]
-    
     embed = discord.Embed(
-        title=f'📊 投票結果: {poll_data["question"]}',
+        title=f'📊 投票結果: {poll.question}',
         color=0x00ff00
     )
     
-    total_votes = sum(poll_data['votes'])
-    winner_index = poll_data['votes'].index(max(poll_data['votes'])) if total_votes > 0 else 0
+    total_votes = sum(poll.votes)
+    winner_index = poll.votes.index(max(poll.votes)) if total_votes > 0 else 0
     
-    for i, option in enumerate(poll_data['options']):
-        votes = poll_data['votes'][i]
+    for i, option in enumerate(poll.options):
+        votes = poll.votes[i]
         percentage = (votes / total_votes * 100) if total_votes > 0 else 0
         status = '🏆 ' if i == winner_index and total_votes > 0 else ''
         
@@ -1095,7 +4222,7 @@ async def poll_results_command(interaction: discord.Interaction, poll_id: str):
     
     embed.add_field(
         name='📈 統計',
-        value=f'**総投票数:** {total_votes}\n**投票者数:** {len(poll_data["voters"])}\n**作成者:** {poll_data["creator"]}',
+        value=f'**総投票数:** {total_votes}\n**投票者数:** {total_votes}\n**作成者:** {poll.creator}',
         inline=False
     )
     
@@ -1109,32 +4236,26 @@ class TicketCloseView(discord.ui.View):
 
     @discord.ui.button(label='🔒 チケットを閉じる', style=discord.ButtonStyle.danger, emoji='🔒', custom_id='close_ticket_button')
     async def close_ticket(self, interaction: discord.Interaction, button: discord.ui.Button):
-        data = load_data()
-        tickets = data.get('tickets', {})
+        ticket = data_store.get_ticket(interaction.guild.id, self.ticket_id)
         
-        if str(self.ticket_id) not in tickets:
+        if ticket is None:
             await interaction.response.send_message('❌ チケットが見つかりません。', ephemeral=True)
             return
         
-        ticket_data = tickets[str(self.ticket_id)]
-        
         # Check if user is ticket creator or admin
-        is_creator = str(interaction.user.id) == ticket_data['user_id']
+        is_creator = interaction.user.id == ticket.user_id
         is_admin = interaction.user.guild_permissions.administrator
         
         if not is_creator and not is_admin:
             await interaction.response.send_message('❌ チケットを閉じる権限がありません。', ephemeral=True)
             return
         
-        if ticket_data['status'] == 'closed':
+        if ticket.status == 'closed':
             await interaction.response.send_message('❌ このチケットは既に閉じられています。', ephemeral=True)
             return
         
         # Update ticket status
-        data['tickets'][str(self.ticket_id)]['status'] = 'closed'
-        data['tickets'][str(self.ticket_id)]['closed_at'] = datetime.now().isoformat()
-        data['tickets'][str(self.ticket_id)]['closed_by'] = str(interaction.user.id)
-        save_data(data)
+        data_store.close_ticket(interaction.guild.id, self.ticket_id, interaction.user.id)
         
         # Send closure message
         embed = discord.Embed(
@@ -1150,7 +4271,6 @@ class TicketCloseView(discord.ui.View):
         view_key = f"ticket_close_{self.ticket_id}"
         if view_key in persistent_views:
             del persistent_views[view_key]
-            save_persistent_views()
         
         # Delete channel after 5 seconds
         import asyncio
@@ -1170,14 +4290,13 @@ class TicketPanelView(discord.ui.View):
         await self.create_ticket_channel(interaction)
     
     async def create_ticket_channel(self, interaction):
-        data = load_data()
-        user_id = str(interaction.user.id)
-        guild_id = str(interaction.guild.id)
+        # Channel setup and the durability wait can outlast the 3 second response deadline
+        await interaction.response.defer(ephemeral=True)
+        user_id = interaction.user.id
+        guild_id = interaction.guild.id
 
         # Create new ticket ID
-        ticket_id = 1
-        while str(ticket_id) in data.get('tickets', {}):
-            ticket_id += 1
+        ticket_id = data_store.next_ticket_id()
 
         try:
             # Check if category exists, create if necessary
@@ -1232,37 +4351,23 @@ class TicketPanelView(discord.ui.View):
             await message.pin()
             
             # Save persistent view data
-            persistent_views[f"ticket_close_{ticket_id}"] = {
-                'type': 'ticket_close',
-                'ticket_id': ticket_id,
-                'guild_id': guild_id,
-                'channel_id': str(channel.id),
-                'message_id': str(message.id)
-            }
-            save_persistent_views()
+            persistent_views[f"ticket_close_{ticket_id}"] = PersistentViewRecord(
+                'ticket_close', guild_id, channel.id, message.id, ticket_id=ticket_id)
             await channel.send(f"{interaction.user.mention} へのメンション", delete_after=1)
 
             # Save ticket data
-            if 'tickets' not in data:
-                data['tickets'] = {}
-
-            data['tickets'][str(ticket_id)] = {
-                'user_id': user_id,
-                'guild_id': guild_id,
-                'channel_id': str(channel.id),
-                'created_at': datetime.now().isoformat(),
-                'description': 'チケット作成',
-                'status': 'open'
-            }
-            save_data(data)
+            data_store.create_ticket(Ticket(ticket_id, guild_id, user_id, channel.id,
+                                            datetime.now().isoformat(), 'チケット作成'))
+            config_registry.flush()  # Queue the persistent view ahead of the barrier
+            await data_store.wait_durable()
 
             # Send confirmation
-            await interaction.response.send_message(f'✅ チケット #{ticket_id} を作成しました！ {channel.mention} で詳細を確認してください。', ephemeral=True)
+            await interaction.followup.send(f'✅ チケット #{ticket_id} を作成しました！ {channel.mention} で詳細を確認してください。', ephemeral=True)
 
         except discord.Forbidden:
-            await interaction.response.send_message('❌ チャンネルを作成する権限がありません。', ephemeral=True)
+            await interaction.followup.send('❌ チャンネルを作成する権限がありません。', ephemeral=True)
         except Exception as e:
-            await interaction.response.send_message(f'❌ チケットの作成に失敗しました: {str(e)}', ephemeral=True)
+            await interaction.followup.send(f'❌ チケットの作成に失敗しました: {str(e)}', ephemeral=True)
 
 @bot.tree.command(name='ticket-panel', description='チケット作成パネルを設置')
 async def ticket_panel(interaction: discord.Interaction, category_name: str = None):
@@ -1295,14 +4400,8 @@ async def ticket_panel(interaction: discord.Interaction, category_name: str = No
         message = await interaction.followup.send(embed=embed, view=view)
         
         # Save persistent view data
-        persistent_views[f"ticket_panel_{message.id}"] = {
-            'type': 'ticket_panel',
-            'category_name': category_name,
-            'guild_id': str(interaction.guild.id),
-            'channel_id': str(interaction.channel.id),
-            'message_id': str(message.id)
-        }
-        save_persistent_views()
+        persistent_views[f"ticket_panel_{message.id}"] = PersistentViewRecord(
+            'ticket_panel', interaction.guild.id, interaction.channel.id, message.id, category_name=category_name)
     except Exception as e:
         print(f"Error in ticket-panel command: {e}")
         try:
@@ -1319,15 +4418,10 @@ async def ticket_list(interaction: discord.Interaction, status: str = "all"):
         await interaction.response.send_message('❌ メッセージ管理権限が必要です。', ephemeral=True)
         return
 
-    data = load_data()
-    tickets = data.get('tickets', {})
-
     # Filter tickets by guild and status
-    guild_tickets = []
-    for ticket_id, ticket_data in tickets.items():
-        if ticket_data['guild_id'] == str(interaction.guild.id):
-            if status == "all" or ticket_data['status'] == status:
-                guild_tickets.append((ticket_id, ticket_data))
+    status_filter = None if status == "all" else status
+    ticket_count = data_store.count_tickets(interaction.guild.id, status_filter)
+    guild_tickets = data_store.list_tickets(interaction.guild.id, status_filter, limit=10)  # Show max 10 tickets
 
     if not guild_tickets:
         await interaction.response.send_message('❌ 該当するチケットが見つかりません。', ephemeral=True)
@@ -1335,23 +4429,23 @@ async def ticket_list(interaction: discord.Interaction, status: str = "all"):
 
     embed = discord.Embed(
         title=f'🎫 チケット一覧 ({status})',
-        description=f'サーバー内のチケット: {len(guild_tickets)}件',
+        description=f'サーバー内のチケット: {ticket_count}件',
         color=0x0099ff
     )
 
-    for ticket_id, ticket_data in guild_tickets[:10]:  # Show max 10 tickets
-        user = interaction.guild.get_member(int(ticket_data['user_id']))
+    for ticket in guild_tickets:
+        user = interaction.guild.get_member(ticket.user_id)
         user_name = user.display_name if user else 'ユーザーが見つかりません'
 
-        status_emoji = '🟢' if ticket_data['status'] == 'open' else '🔴'
+        status_emoji = '🟢' if ticket.status == 'open' else '🔴'
         embed.add_field(
-            name=f'{status_emoji} チケット #{ticket_id}',
-            value=f'**作成者:** {user_name}\n**作成日:** {ticket_data["created_at"][:10]}\n**内容:** {ticket_data["description"][:50]}...',
+            name=f'{status_emoji} チケット #{ticket.ticket_id}',
+            value=f'**作成者:** {user_name}\n**作成日:** {ticket.created_at[:10]}\n**内容:** {ticket.description[:50]}...',
             inline=True
         )
 
-    if len(guild_tickets) > 10:
-        embed.set_footer(text=f'表示: 10/{len(guild_tickets)}件')
+    if ticket_count > 10:
+        embed.set_footer(text=f'表示: 10/{ticket_count}件')
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
@@ -1361,33 +4455,22 @@ async def close_ticket_command(interaction: discord.Interaction, ticket_id: int)
         await interaction.response.send_message('❌ 管理者権限が必要です。', ephemeral=True)
         return
 
-    data = load_data()
-    tickets = data.get('tickets', {})
+    ticket = data_store.get_ticket(interaction.guild.id, ticket_id)
 
-    if str(ticket_id) not in tickets:
+    if ticket is None:
         await interaction.response.send_message('❌ 指定されたチケットが見つかりません。', ephemeral=True)
         return
 
-    ticket_data = tickets[str(ticket_id)]
-
-    if ticket_data['guild_id'] != str(interaction.guild.id):
-        await interaction.response.send_message('❌ このサーバーのチケットではありません。', ephemeral=True)
-        return
-
-    if ticket_data['status'] == 'closed':
+    if ticket.status == 'closed':
         await interaction.response.send_message('❌ このチケットは既に閉じられています。', ephemeral=True)
         return
 
     # Update ticket status
-    data['tickets'][str(ticket_id)]['status'] = 'closed'
-    data['tickets'][str(ticket_id)]['closed_at'] = datetime.now().isoformat()
-    data['tickets'][str(ticket_id)]['closed_by'] = str(interaction.user.id)
-    save_data(data)
+    data_store.close_ticket(interaction.guild.id, ticket_id, interaction.user.id)
 
     # Try to find and delete the channel
-    channel_id = ticket_data.get('channel_id')
-    if channel_id:
-        channel = interaction.guild.get_channel(int(channel_id))
+    if ticket.channel_id:
+        channel = interaction.guild.get_channel(ticket.channel_id)
         if channel:
             try:
                 await channel.delete()
@@ -1442,7 +4525,6 @@ async def setup_server_log(interaction: discord.Interaction, target_server_id: s
             mode_text = 'サーバーの全チャンネル'
             server_log_configs[source_guild_id] = {"target_server": target_server_id, "channel_id": None}
         
-        save_server_log_config()
 
         embed = discord.Embed(
             title='✅ サーバーログ設定完了',
@@ -1474,14 +4556,8 @@ async def server_log_status(interaction: discord.Interaction):
 
     if source_guild_id in server_log_configs:
         config = server_log_configs[source_guild_id]
-        # Handle both old and new format
-        if isinstance(config, dict):
-            target_server_id = config["target_server"]
-            channel_id = config.get("channel_id")
-        else:
-            # Old format (backward compatibility)
-            target_server_id = config
-            channel_id = None
+        target_server_id = config["target_server"]
+        channel_id = config["channel_id"]
             
         target_guild = bot.get_guild(int(target_server_id))
         target_name = target_guild.name if target_guild else f"不明なサーバー (ID: {target_server_id})"
@@ -1512,13 +4588,7 @@ async def server_log_status(interaction: discord.Interaction):
     # Show reverse logging (if this server is a target)
     reverse_configs = []
     for source_id, config in server_log_configs.items():
-        # Handle both old and new format
-        if isinstance(config, dict):
-            target_id = config["target_server"]
-        else:
-            target_id = config
-            
-        if target_id == source_guild_id:
+        if config["target_server"] == source_guild_id:
             source_guild = bot.get_guild(int(source_id))
             source_name = source_guild.name if source_guild else f"不明なサーバー (ID: {source_id})"
             reverse_configs.append(source_name)
@@ -1551,27 +4621,31 @@ MEIGEN_QUOTES = [
     "ルートヴィヒ・ヴァン・ベートーヴェン\n「諸君、喝采せよ。喜劇は終わった。」"
 ]
 
-meigen_channels = {}  # {guild_id: channel_id}
+def normalize_meigen_config(config):
+    """Old configs stored only the channel ID (one quote a day at a random time)"""
+    if isinstance(config, dict):
+        return config
+    return {"channel_id": config, "interval": None}
+
+meigen_channels = config_registry.register('meigen', 'meigen_config.json', normalize_meigen_config)  # {guild_id: {"channel_id", "interval"}}
 meigen_tasks = {}  # {guild_id: task}
 
-def save_meigen_config():
-    """Save meigen channel configuration"""
-    try:
-        with open('meigen_config.json', 'w', encoding='utf-8') as f:
-            json.dump(meigen_channels, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error saving meigen config: {e}")
+def start_meigen_task(guild_id, config):
+    """Start the quote task for a guild's meigen configuration"""
+    if config["interval"]:
+        task = asyncio.create_task(send_interval_meigen(guild_id, config["channel_id"], config["interval"]))
+    else:
+        task = asyncio.create_task(send_daily_meigen(guild_id, config["channel_id"]))
+    meigen_tasks[guild_id] = task
 
-def load_meigen_config():
-    """Load meigen channel configuration"""
-    global meigen_channels
-    try:
-        if os.path.exists('meigen_config.json'):
-            with open('meigen_config.json', 'r', encoding='utf-8') as f:
-                meigen_channels = json.load(f)
-    except Exception as e:
-        print(f"Error loading meigen config: {e}")
-        meigen_channels = {}
+def on_meigen_config_changed(guild_id, config):
+    """Restart the quote task when a guild's meigen configuration changes"""
+    if guild_id in meigen_tasks:
+        meigen_tasks.pop(guild_id).cancel()
+    if config is not None:
+        start_meigen_task(guild_id, config)
+
+meigen_channels.subscribe(on_meigen_config_changed)
 
 async def send_daily_meigen(guild_id, channel_id):
     """Send random quote at random time daily"""
@@ -1717,17 +4791,8 @@ async def meigen_channel_setting(interaction: discord.Interaction, interval: str
     guild_id = str(interaction.guild.id)
     channel_id = str(interaction.channel.id)
 
-    # Save configuration with interval
+    # Save configuration with interval (restarts the quote task)
     meigen_channels[guild_id] = {"channel_id": channel_id, "interval": seconds}
-    save_meigen_config()
-
-    # Stop existing task if any
-    if guild_id in meigen_tasks:
-        meigen_tasks[guild_id].cancel()
-
-    # Start new task with specified interval
-    task = asyncio.create_task(send_interval_meigen(guild_id, channel_id, seconds))
-    meigen_tasks[guild_id] = task
 
     # Format interval display
     if seconds >= 3600:
@@ -1791,13 +4856,13 @@ COMMAND_HELP = {
     },
     'antispam-config': {
         'description': '荒らし対策設定を表示・変更',
-        'usage': '/antispam-config [action]',
-        'details': '同じメッセージの連投を検知して対策します。30秒以内に同じメッセージを3回以上送信した場合、すべての重複メッセージを削除し1時間のタイムアウトを適用します。actionに"show"で設定表示、"reset"でデータリセットができます。メッセージ管理権限が必要です。'
+        'usage': '/antispam-config [操作] [ルール] [値] [チャンネル] [ロール]',
+        'details': 'ルールごとに有効/無効（enable/disable）、回数（count）、秒数（window）、類似判定の一致度（similarity、%）、対処（penalty: delete/timeout/kick/ban）を設定します。ルールは blocklist（禁止ワード・リンク）、duplicate（同一メッセージ）、similar（似たメッセージ）、raid_similar（複数アカウントの類似メッセージ）、flood（大量投稿）です。禁止ワード・ドメイン・招待リンクはblock/unblock（ruleにword/domain/invite、valueに対象）、全ての招待リンクの禁止はblock-all-invites（on/off）で設定します。レイド検知はraid（on/off）、raid-threshold（messages/new_member_messages/mentions/joins）、raid-response（alert/slowmode/timeout_new/kick_joins）、raid-duration、raid-new-member、raid-end（手動解除）で設定します。Bot・Webhookの大量投稿対策はbot-flood（on/off）、bot-flood-burst（連続投稿数）、bot-flood-rate（毎秒の投稿数）、bot-flood-penalty（delete/kick/ban）で設定します。タイムアウト時間（timeout）、検知のみ行うシャドーモード（shadow on/off）、対象外チャンネル・ロール（exempt-channel/exempt-role）も設定できます。"show"で設定と検知回数の表示、"reset"で検知データのリセット、"reset-rules"でルールの初期化ができます。メッセージ管理権限（ルール変更はサーバー管理権限）が必要です。'
     },
     'spam-status': {
         'description': '現在のスパム検知状況を表示',
         'usage': '/spam-status',
-        'details': '現在監視中のユーザー数やBotの追跡状況を表示します。メッセージ管理権限が必要です。'
+        'details': '現在監視中のユーザー数やBotの追跡状況、レイドモードの状態と直近の活動量を表示します。メッセージ管理権限が必要です。'
     },
     'giveaway': {
         'description': 'Giveawayを開始',
@@ -1863,8 +4928,13 @@ COMMAND_HELP = {
     },
     'ranking': {
         'description': 'サーバーのレベルランキングを表示',
-        'usage': '/ranking',
-        'details': 'サーバー内のユーザーのレベルランキングを表示します。上位10名まで表示されます。'
+        'usage': '/ranking [server/global] [ページ]',
+        'details': 'サーバー内のユーザーのレベルランキングを10名ずつ表示します。ボタンで前後のページに移動できます。globalを指定すると全サーバーのランキング（各ユーザーの最高サーバーXP）を表示します。'
+    },
+    'xp-config': {
+        'description': '経験値の獲得ルールを表示・変更',
+        'usage': '/xp-config [操作] [値] [チャンネル] [ロール]',
+        'details': '基本XP（base）、クールダウン秒数（cooldown）、最小文字数（min-length）、対象外チャンネル（ignore/unignore）、チャンネル・ロール倍率（channel-multiplier/role-multiplier）を設定します。サーバー管理権限が必要です。'
     },
     'delete': {
         'description': '指定した数のメッセージを削除',
@@ -2119,32 +5189,21 @@ def run_bot():
         print('DISCORD_TOKEN環境変数が設定されていません。')
         return
     print("Starting Discord bot...")
-    bot.run(token)
-
-server_log_configs = {}
-
-def save_server_log_config():
-    try:
-        with open('server_log_config.json', 'w', encoding='utf-8') as f:
-            json.dump(server_log_configs, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error saving server log config: {e}")
-
-def load_server_log_config():
-    global server_log_configs
     try:
-        if os.path.exists('server_log_config.json'):
-            with open('server_log_config.json', 'r', encoding='utf-8') as f:
-                server_log_configs = json.load(f)
-    except Exception as e:
-        print(f"Error loading server log config: {e}")
-        server_log_configs = {}
-
-async def on_message_for_copy(message):
-    pass
+        bot.run(token)
+    finally:
+        xp_accumulator.apply()
+        data_store.flush()
+        config_registry.flush()
+        file_writer.drain()
+
+def normalize_server_log_config(config):
+    """Old configs stored only the target server ID (all channels)"""
+    if isinstance(config, dict):
+        return config
+    return {"target_server": config, "channel_id": None}
 
-async def on_message_for_server_translation(message):
-    pass
+server_log_configs = config_registry.register('server_log', 'server_log_config.json', normalize_server_log_config)
 
 async def on_message_for_server_logging(message):
     if message.author.bot:
@@ -2153,14 +5212,10 @@ async def on_message_for_server_logging(message):
     if source_guild_id not in server_log_configs:
         return
     config = server_log_configs[source_guild_id]
-    if isinstance(config, dict):
-        target_guild_id = config["target_server"]
-        specific_channel_id = config.get("channel_id")
-        if specific_channel_id and str(message.channel.id) != specific_channel_id:
-            return
-    else:
-        target_guild_id = config
-        specific_channel_id = None
+    target_guild_id = config["target_server"]
+    specific_channel_id = config["channel_id"]
+    if specific_channel_id and str(message.channel.id) != specific_channel_id:
+        return
     target_guild = bot.get_guild(int(target_guild_id))
     if not target_guild:
         print(f"Target guild {target_guild_id} not found")
@@ -2210,24 +5265,16 @@ async def on_message_for_server_logging(message):
     except Exception as e:
         print(f"Failed to send log message: {e}")
 
-channel_configs = {}
+def server_logging_channels(guild_id):
+    config = server_log_configs.get(str(guild_id))
+    if config is None:
+        return None
+    return {int(config["channel_id"])} if config["channel_id"] else ALL_CHANNELS
 
-def save_translation_config():
-    try:
-        with open('channel_config.json', 'w', encoding='utf-8') as f:
-            json.dump(channel_configs, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error saving channel config: {e}")
+register_message_feature('server_logging', on_message_for_server_logging, server_logging_channels, commands=True)
+server_log_configs.subscribe(lambda guild_id, config: invalidate_message_routes(guild_id))
 
-def load_translation_config():
-    global channel_configs
-    try:
-        if os.path.exists('channel_config.json'):
-            with open('channel_config.json', 'r', encoding='utf-8') as f:
-                channel_configs = json.load(f)
-    except Exception as e:
-        print(f"Error loading channel config: {e}")
-        channel_configs = {}
+channel_configs = config_registry.register('translation', 'channel_config.json')
 
 async def create_channel_if_not_exists(guild, channel_name, channel_type="text", category_name=None):
     existing_channel = discord.utils.get(guild.channels, name=channel_name)
@@ -2354,35 +5401,11 @@ async def stop_timenuke_command(interaction: discord.Interaction):
     await interaction.response.send_message(embed=embed)
 
 def get_user_warnings(user_id, guild_id):
-    data = load_data()
-    if 'warnings' not in data:
-        data['warnings'] = {}
-    guild_key = str(guild_id)
-    user_key = str(user_id)
-    if guild_key not in data['warnings']:
-        data['warnings'][guild_key] = {}
-    if user_key not in data['warnings'][guild_key]:
-        return 0
-    return data['warnings'][guild_key][user_key]['count']
+    warning_data = data_store.get_warnings(guild_id, user_id, limit=0)
+    return warning_data['count'] if warning_data else 0
 
 def add_user_warning(user_id, guild_id, reason, moderator_id):
-    data = load_data()
-    if 'warnings' not in data:
-        data['warnings'] = {}
-    guild_key = str(guild_id)
-    user_key = str(user_id)
-    if guild_key not in data['warnings']:
-        data['warnings'][guild_key] = {}
-    if user_key not in data['warnings'][guild_key]:
-        data['warnings'][guild_key][user_key] = {'count': 0, 'history': []}
-    data['warnings'][guild_key][user_key]['count'] += 1
-    data['warnings'][guild_key][user_key]['history'].append({
-        'reason': reason,
-        'moderator_id': str(moderator_id),
-        'timestamp': datetime.now().isoformat()
-    })
-    save_data(data)
-    return data['warnings'][guild_key][user_key]['count']
+    return data_store.add_warning(guild_id, user_id, reason, moderator_id)
 
 @bot.tree.command(name='warn', description='ユーザーに警告を与える')
 async def warn_user(interaction: discord.Interaction, user: discord.Member, reason: str = "規則違反"):
@@ -2442,29 +5465,25 @@ async def show_warnings(interaction: discord.Interaction, user: discord.Member):
         await interaction.response.send_message('❌ メッセージ管理権限が必要です。', ephemeral=True)
         return
 
-    data = load_data()
-    guild_key = str(interaction.guild.id)
-    user_key = str(user.id)
+    warning_data = data_store.get_warnings(interaction.guild.id, user.id, limit=5)
 
-    if ('warnings' not in data or guild_key not in data['warnings'] or 
-        user_key not in data['warnings'][guild_key]):
+    if warning_data is None:
         await interaction.response.send_message(f'❌ {user.display_name}の警告記録はありません。', ephemeral=True)
         return
 
-    warning_data = data['warnings'][guild_key][user_key]
     embed = discord.Embed(
         title=f'⚠️ {user.display_name}の警告履歴',
         description=f'**警告回数:** {warning_data["count"]}/3',
         color=0xff9900
     )
 
-    for i, warning in enumerate(warning_data['history'][-5:], 1):  # Show last 5 warnings
-        moderator = interaction.guild.get_member(int(warning['moderator_id']))
+    for i, warning in enumerate(warning_data['history'], 1):  # Show last 5 warnings
+        moderator = interaction.guild.get_member(warning.moderator_id) if warning.moderator_id else None
         moderator_name = moderator.display_name if moderator else '不明'
         
         embed.add_field(
             name=f'警告 #{i}',
-            value=f'**理由:** {warning["reason"]}\n**モデレーター:** {moderator_name}\n**日時:** {warning["timestamp"][:10]}',
+            value=f'**理由:** {warning.reason}\n**モデレーター:** {moderator_name}\n**日時:** {warning.timestamp[:10]}',
             inline=False
         )
 
@@ -2564,20 +5583,7 @@ class ServerLinkAuthView(discord.ui.View):
 
         if user_servers:
             # User has access to linked servers - grant authentication
-            data = load_data()
-            user_id = str(interaction.user.id)
-
-            if user_id not in data['users']:
-                data['users'][user_id] = {
-                    'authenticated': True,
-                    'join_date': datetime.now().isoformat(),
-                    'server_link_auth': True
-                }
-            else:
-                data['users'][user_id]['authenticated'] = True
-                data['users'][user_id]['server_link_auth'] = True
-
-            save_data(data)
+            data_store.authenticate_user(interaction.user.id, server_link_auth=True)
 
             embed = discord.Embed(
                 title='✅ サーバーリンク認証成功',
@@ -2887,7 +5893,6 @@ async def allmessage_command(interaction: discord.Interaction, target_server_id:
             server_log_configs[source_guild_id] = {"target_server": target_server_id, "channel_id": channel_id}
         else:
             server_log_configs[source_guild_id] = {"target_server": target_server_id, "channel_id": None}
-        save_server_log_config()
 
         await interaction.response.send_message(
             f'✅ メッセージコピーを開始しました。\n**転送先:** {target_guild.name}\n**対象:** {mode_text}\n\n処理には時間がかかる場合があります。進行状況は別メッセージで更新されます。\n\n🔄 **サーバーログも自動で設定されました。**', 
@@ -3398,6 +6403,10 @@ COMMAND_HELP.update({
     }
 })
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['migrate-sqlite']:
+        migrate_json_to_sqlite()
+        exit(0)
+
     # Start Flask server in a separate thread
     flask_thread = Thread(target=run_flask)
     flask_thread.daemon = True
@@ -3412,4 +6421,10 @@ if __name__ == '__main__':
         print('DISCORD_TOKEN環境変数が設定されていません。')
         exit(1)
 
-    bot.run(token)
+    try:
+        bot.run(token)
+    finally:
+        xp_accumulator.apply()
+        data_store.flush()
+        config_registry.flush()
+        file_writer.drain()